@@ -0,0 +1,129 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Caller identity for the current request ("emr:<id>" or "anon:<ip>"), set by the
+# admission dependency so upstream guards deep in a handler know whom to charge.
+current_client: ContextVar = ContextVar("current_client", default="anon:internal")
+
+
+class AdmissionDenied(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, now) -> float:
+        """Take one token; returns 0 on success, else seconds until one is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """In-process admission control: O(1) dict/bucket work per request.
+
+    - per-client token bucket on every guarded request (admit)
+    - per-client cap on concurrent upstream-bound work (upstream)
+    - a global rate + concurrency budget per upstream service (WHO, Supabase)
+    Anything over budget is rejected immediately with a Retry-After hint rather
+    than queued.
+    """
+
+    def __init__(self, client_rate=5.0, client_burst=20, client_concurrency=4,
+                 upstream_rate=None, upstream_concurrency=None, max_clients=10000):
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.client_concurrency = client_concurrency
+        self.upstream_rate = upstream_rate or {}                # service -> calls/s
+        self.upstream_concurrency = upstream_concurrency or {}  # service -> in-flight cap
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # client -> TokenBucket, LRU-bounded
+        self._client_inflight = {}     # client -> upstream calls in flight
+        self._upstream_buckets = {}
+        self._upstream_inflight = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            client_rate=float(os.getenv("ADMISSION_CLIENT_RATE", "5")),
+            client_burst=int(os.getenv("ADMISSION_CLIENT_BURST", "20")),
+            client_concurrency=int(os.getenv("ADMISSION_CLIENT_CONCURRENCY", "4")),
+            upstream_rate={
+                "who": float(os.getenv("ADMISSION_WHO_RATE", "20")),
+                "supabase": float(os.getenv("ADMISSION_SUPABASE_RATE", "50")),
+            },
+            upstream_concurrency={
+                "who": int(os.getenv("ADMISSION_WHO_CONCURRENCY", "16")),
+                "supabase": int(os.getenv("ADMISSION_SUPABASE_CONCURRENCY", "32")),
+            },
+        )
+
+    def admit(self, client):
+        """Charge one request to client's bucket or raise AdmissionDenied."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = TokenBucket(self.client_rate, self.client_burst, now)
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+            wait = bucket.take(now)
+        if wait:
+            raise AdmissionDenied(f"Rate limit exceeded for {client}", wait)
+
+    @contextmanager
+    def upstream(self, service, client=None):
+        """Guard one upstream call made on behalf of client (default: current request)."""
+        client = client or current_client.get()
+        now = time.monotonic()
+        with self._lock:
+            if self._client_inflight.get(client, 0) >= self.client_concurrency:
+                raise AdmissionDenied(f"Too many concurrent upstream calls for {client}", 1)
+            cap = self.upstream_concurrency.get(service)
+            if cap is not None and self._upstream_inflight.get(service, 0) >= cap:
+                raise AdmissionDenied(f"{service} upstream budget exhausted", 1)
+            rate = self.upstream_rate.get(service)
+            if rate is not None:
+                bucket = self._upstream_buckets.get(service)
+                if bucket is None:
+                    bucket = self._upstream_buckets[service] = TokenBucket(rate, max(rate, 1), now)
+                wait = bucket.take(now)
+                if wait:
+                    raise AdmissionDenied(f"{service} upstream budget exhausted", wait)
+            self._client_inflight[client] = self._client_inflight.get(client, 0) + 1
+            self._upstream_inflight[service] = self._upstream_inflight.get(service, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                left = self._client_inflight[client] - 1
+                if left:
+                    self._client_inflight[client] = left
+                else:
+                    del self._client_inflight[client]
+                self._upstream_inflight[service] -= 1
+
+
+def retry_after_header(denied: AdmissionDenied) -> str:
+    return str(max(1, math.ceil(denied.retry_after)))
@@ -0,0 +1,206 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Data layer for streamlit_app.py: one pooled session, TTL-bounded caches and batched
+# resolution of selected codes, so Streamlit reruns don't re-hit the API.
+
+API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000").rstrip("/")
+TIMEOUT = 15
+# concurrent $lookup calls; must not exceed the API's per-client upstream cap
+# (ADMISSION_CLIENT_CONCURRENCY) or cold batches come back as 429s
+LOOKUP_WORKERS = int(os.getenv("LOOKUP_WORKERS", os.getenv("ADMISSION_CLIENT_CONCURRENCY", "4")))
+
+
+@st.cache_resource
+def get_session() -> requests.Session:
+    session = requests.Session()
+    # 429s from admission control carry Retry-After, which Retry honours
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=LOOKUP_WORKERS * 2, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get(path, **params):
+    r = get_session().get(f"{API_BASE_URL}{path}", params=params or None, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r
+
+
+def post(path, params=None, json=None):
+    r = get_session().post(f"{API_BASE_URL}{path}", params=params, json=json, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r
+
+
+# ---------- memoized reads ----------
+@st.cache_data(ttl=600, max_entries=8, show_spinner=False)
+def codesystem(version=None) -> dict:
+    return get("/CodeSystem/namaste", **({"_history": version} if version else {})).json()
+
+
+@st.cache_data(ttl=600, max_entries=8, show_spinner=False)
+def conceptmap(version=None) -> dict:
+    return get("/ConceptMap/namaste-tm2", **({"_history": version} if version else {})).json()
+
+
+@st.cache_data(ttl=600, max_entries=2, show_spinner=False)
+def concept_index() -> dict:
+    """NAMC code -> CodeSystem concept."""
+    return {c["code"]: c for c in codesystem().get("concept", [])}
+
+
+@st.cache_data(ttl=600, max_entries=2, show_spinner=False)
+def tm2_index() -> dict:
+    """NAMC code -> TM2 code, from the ConceptMap."""
+    index = {}
+    for group in conceptmap().get("group", []):
+        for element in group.get("element", []):
+            targets = element.get("target") or []
+            if targets:
+                index[element["code"]] = targets[0]["code"]
+    return index
+
+
+@st.cache_data(ttl=120, max_entries=256, show_spinner=False)
+def expand(filter_text) -> list:
+    return get("/ValueSet/namaste/$expand", filter=filter_text).json().get("expansion", [])
+
+
+class TTLCache:
+    """Thread-safe key -> value cache with per-entry expiry and a size bound."""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return None
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                now = time.monotonic()
+                for k in [k for k, (expires, _) in self._data.items() if expires < now]:
+                    del self._data[k]
+                if len(self._data) >= self.maxsize:
+                    # still full: drop the entry closest to expiry
+                    del self._data[min(self._data, key=lambda k: self._data[k][0])]
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+
+@st.cache_resource
+def _lookup_cache() -> TTLCache:
+    return TTLCache(ttl=3600, maxsize=2048)
+
+
+_NOT_FOUND = {}
+
+
+def _fetch_lookup(code):
+    try:
+        return get("/CodeSystem/biomed/$lookup", code=code).json()
+    except requests.HTTPError as he:
+        if he.response is not None and he.response.status_code == 404:
+            return _NOT_FOUND
+        raise
+
+
+def lookup(code):
+    """biomed $lookup result, or None if the code is unknown. Other errors propagate."""
+    cache = _lookup_cache()
+    data = cache.get(code)
+    if data is None:
+        data = _fetch_lookup(code)
+        cache.put(code, data)
+    return None if data is _NOT_FOUND else data
+
+
+def lookup_many(codes) -> dict:
+    """Resolve TM2 / biomed codes; cached ones are free, the rest are fetched concurrently.
+
+    Returns code -> lookup result for the codes that were found. Codes whose lookup
+    failed for other reasons are missing from the result.
+    """
+    cache = _lookup_cache()
+    found, missing = {}, []
+    for code in dict.fromkeys(c for c in codes if c):
+        hit = cache.get(code)
+        if hit is None:
+            missing.append(code)
+        elif hit is not _NOT_FOUND:
+            found[code] = hit
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(LOOKUP_WORKERS, len(missing))) as pool:
+            futures = {code: pool.submit(_fetch_lookup, code) for code in missing}
+        for code, future in futures.items():
+            try:
+                data = future.result()
+            except Exception:
+                continue
+            cache.put(code, data)
+            if data is not _NOT_FOUND:
+                found[code] = data
+    return found
+
+
+def resolve_disorders(selected):
+    """Turn [(NAMC code, display), ...] into the records the Bundle tab keeps.
+
+    NAMASTE details and TM2 codes come from the cached CodeSystem / ConceptMap and
+    TM2 details from one batched lookup, instead of three requests per code.
+    Returns (records, warnings).
+    """
+    warnings = []
+    try:
+        concepts = concept_index()
+    except Exception as e:
+        concepts = {}
+        warnings.append(f"Could not fetch NAMASTE details: {e}")
+    try:
+        mappings = tm2_index()
+    except Exception as e:
+        mappings = {}
+        warnings.append(f"Could not fetch NAMASTE-TM2 mappings: {e}")
+
+    tm2_codes = {code: mappings.get(code, "") for code, _ in selected}
+    for code, tm2_code in tm2_codes.items():
+        if not tm2_code and mappings:
+            warnings.append(f"No TM2 mapping found for {code}")
+    details = lookup_many(tm2_codes.values())
+
+    records = []
+    for code, display in selected:
+        concept = concepts.get(code, {})
+        tm2_code = tm2_codes[code]
+        tm2 = details.get(tm2_code, {})
+        if tm2_code and not tm2:
+            warnings.append(f"Could not fetch TM2 details for {tm2_code}")
+        records.append({
+            "code": code,
+            "display": display,
+            "tm2_code": tm2_code,
+            "tm2_display": tm2.get("display", "") or "",
+            "tm2_definition": tm2.get("definition", "") or "",
+            "namaste_short": concept.get("display", display),
+            "namaste_long": concept.get("definition", ""),
+            "index_term": display,  # Assume IndexTerm is the display; adjust if diacritical is needed
+        })
+    return records, warnings
@@ -0,0 +1,131 @@
+import asyncio
+import os
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from profiling import span
+from dotenv import load_dotenv
+load_dotenv()
+
+# Async counterpart of db.py for the ABHA router: one pooled AsyncClient per worker and
+# a request-scoped DataSession whose identity map serves repeated reads of the same
+# abha_links / emr_clients row without another round trip.
+
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "20"))
+TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+
+_client: "AsyncClient" = None
+_client_lock = asyncio.Lock()
+
+
+async def get_client() -> "AsyncClient":
+    global _client
+    if _client is None:
+        async with _client_lock:
+            if _client is None:
+                # supabase/httpx are imported here so importing this module stays cheap
+                import httpx
+                from supabase import AsyncClientOptions, acreate_client
+                http = httpx.AsyncClient(
+                    timeout=TIMEOUT,
+                    limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+                )
+                _client = await acreate_client(
+                    SUPABASE_URL, SUPABASE_KEY,
+                    options=AsyncClientOptions(httpx_client=http, postgrest_client_timeout=TIMEOUT),
+                )
+    return _client
+
+
+class DataSession:
+    """Supabase access for one request.
+
+    Rows read through get_abha_link / get_emr_client are kept in an identity map keyed
+    by (table, key); concurrent reads of the same key share one query, and writes made
+    through the session update the map instead of forcing a re-read.
+    """
+
+    def __init__(self, client: "AsyncClient"):
+        self.client = client
+        self._rows = {}      # (table, key) -> row or None
+        self._pending = {}   # (table, key) -> in-flight read
+
+    async def _get_one(self, table, column, key):
+        ident = (table, key)
+        if ident in self._rows:
+            return self._rows[ident]
+        pending = self._pending.get(ident)
+        if pending is None:
+            pending = asyncio.ensure_future(
+                self.client.table(table).select("*").eq(column, key).execute()
+            )
+            self._pending[ident] = pending
+            try:
+                with span("supabase", f"select {table}"):
+                    response = await pending
+            finally:
+                self._pending.pop(ident, None)
+            row = response.data[0] if response.data else None
+            self._rows[ident] = row
+            return row
+        response = await pending
+        return response.data[0] if response.data else None
+
+    def _merge(self, table, key, values):
+        ident = (table, key)
+        row = self._rows.get(ident)
+        self._rows[ident] = {**row, **values} if row else dict(values)
+
+    # ---------- emr_clients ----------
+    async def get_emr_client(self, client_id: str):
+        return await self._get_one("emr_clients", "client_id", client_id)
+
+    # ---------- abha_links ----------
+    async def get_abha_link(self, emr_patient_id: str):
+        return await self._get_one("abha_links", "emr_patient_id", emr_patient_id)
+
+    async def upsert_abha_link(self, record: dict):
+        with span("supabase", "upsert abha_links"):
+            response = await self.client.table("abha_links").upsert(record, on_conflict="emr_patient_id").execute()
+        self._merge("abha_links", record["emr_patient_id"], response.data[0] if response.data else record)
+        return response
+
+    async def update_abha_link(self, emr_patient_id: str, updates: dict):
+        with span("supabase", "update abha_links"):
+            response = await self.client.table("abha_links").update(updates).eq("emr_patient_id", emr_patient_id).execute()
+        if response.data:
+            self._merge("abha_links", emr_patient_id, response.data[0])
+        else:
+            self._rows.pop(("abha_links", emr_patient_id), None)
+        return response
+
+    # ---------- audit_logs ----------
+    async def log_event(self, event_type: str, emr_patient_id: str, metadata: dict = None, emr_client_id: str = None):
+        log_data = {
+            "event_type": event_type,
+            "emr_patient_id": emr_patient_id,
+            "metadata": metadata or {},
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        if emr_client_id is not None:
+            log_data["emr_client_id"] = emr_client_id
+        with span("supabase", "insert audit_logs"):
+            return await self.client.table("audit_logs").insert(log_data).execute()
+
+    async def get_audit_logs(self, emr_patient_id: str):
+        with span("supabase", "select audit_logs"):
+            response = await self.client.table("audit_logs").select("*").eq(
+                "emr_patient_id", emr_patient_id
+            ).order("timestamp", desc=True).execute()
+        return response.data
+
+
+async def get_data_session():
+    """FastAPI dependency; FastAPI caches it per request, so every dependency of one
+    request shares the same identity map."""
+    return DataSession(await get_client())
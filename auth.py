@@ -5,10 +5,13 @@ import hashlib
 from fastapi import APIRouter, Request, HTTPException, Depends , Header
 from fastapi.responses import RedirectResponse, JSONResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from authlib.integrations.starlette_client import OAuth
+import threading
+from contextlib import nullcontext
 from starlette.config import Config
-from db import upsert_abha_link, get_abha_link, update_abha_link, log_event, supabase
+from async_db import DataSession, get_data_session
 from secure import encrypt_value, decrypt_value
+from profiling import span
+from lru import LRU
 
 
 router = APIRouter()
@@ -22,40 +25,93 @@ REDIRECT_URI = os.getenv("ABHA_REDIRECT_URI", "http://localhost:8000/abha/callba
 API_KEY = os.getenv("MYAPIKEY")
 security = HTTPBasic()
 
-if not ABHA_CLIENT_ID or not ABHA_CLIENT_SECRET:
-    raise RuntimeError("Set ABHA_CLIENT_ID and ABHA_CLIENT_SECRET")
-
 
 # Client id/secret auth for EMR systems
 
-async def authenticate_emr_client(credentials: HTTPBasicCredentials = Depends(security)):
-    response = supabase.table("emr_clients").select("*").eq("client_id", credentials.username).execute()
-    clients = response.data
-    if not clients or clients[0]["client_secret"] != credentials.password:
+async def authenticate_emr_client(credentials: HTTPBasicCredentials = Depends(security),
+                                  db: DataSession = Depends(get_data_session)):
+    client = await db.get_emr_client(credentials.username)
+    if not client or client["client_secret"] != credentials.password:
         raise HTTPException(status_code=401, detail="Invalid client credentials")
-    return clients[0]  # includes UUID emr_client.id
-
-# minimal Config for Authlib
-config = Config(environ={
-    "ABHA_CLIENT_ID": ABHA_CLIENT_ID,
-    "ABHA_CLIENT_SECRET": ABHA_CLIENT_SECRET,
-    "ABHA_REDIRECT_URI": REDIRECT_URI
-})
-oauth = OAuth(config)
-oauth.register(
-#    name="abha",
-#    client_id=ABHA_CLIENT_ID,
- #   client_secret=ABHA_CLIENT_SECRET,
-  #  authorize_url=ABHA_AUTHORIZE_URL,
-   # access_token_url=ABHA_TOKEN_URL,
-    #client_kwargs={"scope": "openid profile"},  # adjust per ABDM docs
-
-    name="abha",   # google dummy authentication for demo
-    client_id=ABHA_CLIENT_ID,
-    client_secret=ABHA_CLIENT_SECRET,
-    server_metadata_url="https://accounts.google.com/.well-known/openid-configuration",
-    client_kwargs={"scope": "openid profile email"}
-)
+    return client  # includes UUID emr_client.id
+
+# Same check for endpoints that also serve unauthenticated callers: None without
+# credentials (no Supabase client is touched), 401 for wrong ones
+optional_security = HTTPBasic(auto_error=False)
+
+# Authentications are cached briefly so guarded endpoints don't pay a Supabase round
+# trip per request: (client_id, sha256(secret)) -> (client or None, expires). Failed
+# checks are cached too (shorter), so wrong credentials can't force a read per request.
+EMR_AUTH_TTL = float(os.getenv("EMR_CLIENT_AUTH_TTL", "60"))
+EMR_AUTH_FAIL_TTL = float(os.getenv("EMR_CLIENT_AUTH_FAIL_TTL", "10"))
+EMR_AUTH_MAX = 1024
+_emr_auth_cache = LRU(EMR_AUTH_MAX)
+
+async def cached_emr_client(credentials: HTTPBasicCredentials, guard=nullcontext):
+    """authenticate_emr_client with a short-TTL cache; guard() wraps the Supabase read."""
+    key = (credentials.username, hashlib.sha256(credentials.password.encode()).digest())
+    now = time.monotonic()
+    hit = _emr_auth_cache.get(key)
+    if hit and hit[1] > now:
+        if hit[0] is None:
+            raise HTTPException(status_code=401, detail="Invalid client credentials")
+        return hit[0]
+    try:
+        with guard():
+            client = await authenticate_emr_client(credentials, await get_data_session())
+    except HTTPException as e:
+        if e.status_code == 401:
+            _emr_auth_cache.put(key, (None, now + EMR_AUTH_FAIL_TTL))
+        raise
+    _emr_auth_cache.put(key, (client, now + EMR_AUTH_TTL))
+    return client
+
+async def optional_emr_client(credentials: HTTPBasicCredentials = Depends(optional_security)):
+    if credentials is None:
+        return None
+    return await cached_emr_client(credentials)
+
+# OAuth registry is built on first use: authlib is only imported (and the client
+# credentials only checked) when an ABHA flow actually runs, not at import time
+_oauth = None
+_oauth_lock = threading.Lock()
+
+def get_oauth():
+    global _oauth
+    if _oauth is None:
+        with _oauth_lock:
+            if _oauth is None:
+                if not ABHA_CLIENT_ID or not ABHA_CLIENT_SECRET:
+                    raise RuntimeError("Set ABHA_CLIENT_ID and ABHA_CLIENT_SECRET")
+                from authlib.integrations.starlette_client import OAuth
+
+                # minimal Config for Authlib
+                config = Config(environ={
+                    "ABHA_CLIENT_ID": ABHA_CLIENT_ID,
+                    "ABHA_CLIENT_SECRET": ABHA_CLIENT_SECRET,
+                    "ABHA_REDIRECT_URI": REDIRECT_URI
+                })
+                oauth = OAuth(config)
+                oauth.register(
+                #    name="abha",
+                #    client_id=ABHA_CLIENT_ID,
+                 #   client_secret=ABHA_CLIENT_SECRET,
+                  #  authorize_url=ABHA_AUTHORIZE_URL,
+                   # access_token_url=ABHA_TOKEN_URL,
+                    #client_kwargs={"scope": "openid profile"},  # adjust per ABDM docs
+
+                    name="abha",   # google dummy authentication for demo
+                    client_id=ABHA_CLIENT_ID,
+                    client_secret=ABHA_CLIENT_SECRET,
+                    server_metadata_url="https://accounts.google.com/.well-known/openid-configuration",
+                    client_kwargs={"scope": "openid profile email"}
+                )
+                _oauth = oauth
+    return _oauth
+
+async def warm_oauth():
+    """Fetch the provider metadata ahead of the first login (used at startup)."""
+    await get_oauth().abha.load_server_metadata()
 
 # ---------- PKCE helpers ----------
 def generate_pkce_pair():
@@ -64,8 +120,8 @@ def generate_pkce_pair():
     return code_verifier, code_challenge
 
 # ---------- refresh token automatically ----------
-async def get_valid_access_token(emr_patient_id: str) -> str:
-    rec = get_abha_link(emr_patient_id)
+async def get_valid_access_token(emr_patient_id: str, db: DataSession) -> str:
+    rec = await db.get_abha_link(emr_patient_id)
     if not rec:
         raise HTTPException(status_code=404, detail="Not linked")
 
@@ -87,7 +143,7 @@ async def get_valid_access_token(emr_patient_id: str) -> str:
     refresh_token = decrypt_value(refresh_token_encrypted)
 
     # Use OAuth client to refresh token
-    client = oauth.create_client("abha")
+    client = get_oauth().create_client("abha")
     try:
         new_token = await client.fetch_access_token(
             #ABHA_TOKEN_URL, use when using ABDM
@@ -104,19 +160,20 @@ async def get_valid_access_token(emr_patient_id: str) -> str:
     enc_refresh = encrypt_value(new_token.get("refresh_token", refresh_token))
     new_expires_at = int(time.time()) + new_token.get("expires_in", 3600)
 
-    update_abha_link(emr_patient_id, {
+    await db.update_abha_link(emr_patient_id, {
         "access_token": enc_access,
         "refresh_token": enc_refresh,
         "expires_at": new_expires_at
     })
 
-    log_event("abha_token_refreshed", emr_patient_id, {"expires_at": new_expires_at})
+    await db.log_event("abha_token_refreshed", emr_patient_id, {"expires_at": new_expires_at})
 
     return new_token["access_token"]
 
 # 1) Start linking: redirect user to ABHA auth with PKCE
 @router.get("/link/{emr_patient_id}")
-async def link_abha(emr_patient_id: str, request: Request, emr_client=Depends(authenticate_emr_client)):
+async def link_abha(emr_patient_id: str, request: Request, emr_client=Depends(authenticate_emr_client),
+                    db: DataSession = Depends(get_data_session)):
     code_verifier, code_challenge = generate_pkce_pair()
     # store code_verifier temporarily (in production: DB or secure cookie)
     # For hackathon: store in memory keyed by state (or better: store in Supabase 'abha_links' row as temp)
@@ -124,7 +181,7 @@ async def link_abha(emr_patient_id: str, request: Request, emr_client=Depends(au
     # We'll pass PKCE challenge via 'code_challenge' param—Authlib supports custom params
 
     # store verifier in Supabase temporary record
-    upsert_abha_link({
+    await db.upsert_abha_link({
         "emr_patient_id": emr_patient_id,
         "access_token": "",
         "refresh_token": "",
@@ -134,9 +191,9 @@ async def link_abha(emr_patient_id: str, request: Request, emr_client=Depends(au
         "emr_client_id": emr_client["id"]
     })
     # store code_verifier in-memory map for demo (replace with DB + TTL in production)
-    log_event("abha_link_started", emr_patient_id, {"method": "PKCE"})
+    await db.log_event("abha_link_started", emr_patient_id, {"method": "PKCE"}, emr_client["id"])
 
-    redirect = await oauth.abha.authorize_redirect(
+    redirect = await get_oauth().abha.authorize_redirect(
         request,
         REDIRECT_URI,
         state=state,
@@ -147,7 +204,8 @@ async def link_abha(emr_patient_id: str, request: Request, emr_client=Depends(au
 
 # 2) Callback — exchange code (use stored verifier)
 @router.get("/callback")
-async def callback(request: Request, emr_client=Depends(authenticate_emr_client)):
+async def callback(request: Request, emr_client=Depends(authenticate_emr_client),
+                   db: DataSession = Depends(get_data_session)):
     try:
         # authlib will parse code from request
         state = request.query_params.get("state")
@@ -155,14 +213,15 @@ async def callback(request: Request, emr_client=Depends(authenticate_emr_client)
             raise HTTPException(status_code=400, detail="Missing state")
         # retrieve code_verifier (demo: from request.session)
         code_verifier = None
-        rec = get_abha_link(state)
+        rec = await db.get_abha_link(state)
         code_verifier = rec.get("code_verifier_temp") if rec else None
 
         # If not found in session, try fetch from DB or reject
         if not code_verifier:
             # fallback: in production, fetch from secure store; for demo, throw error
             raise HTTPException(status_code=400, detail="Missing PKCE verifier; complete/restart flow from same browser")
-        token = await oauth.abha.authorize_access_token(request, code_verifier=code_verifier)
+        with span("oauth", "authorize_access_token"):
+            token = await get_oauth().abha.authorize_access_token(request, code_verifier=code_verifier)
 
         # import json, sys
         # print("TOKEN RESPONSE:", json.dumps(token, indent=2), file=sys.stderr, flush=True)
@@ -177,7 +236,7 @@ async def callback(request: Request, emr_client=Depends(authenticate_emr_client)
 
 # If userinfo isn’t there, fall back to userinfo endpoint
         if not userinfo:
-            client = oauth.create_client("abha")
+            client = get_oauth().create_client("abha")
             userinfo = await client.userinfo()
 
 
@@ -205,10 +264,11 @@ async def callback(request: Request, emr_client=Depends(authenticate_emr_client)
         # encrypt tokens
        # enc_access = encrypt_value(access_token) if access_token else ""
        # enc_refresh = encrypt_value(refresh_token) if refresh_token else ""
-        existing_link = get_abha_link(emr_patient_id)
+        # served from the request's identity map; no second round trip
+        existing_link = await db.get_abha_link(emr_patient_id)
         if not existing_link:
             raise HTTPException(status_code=404, detail="Link record not found")
-        upsert_abha_link({
+        await db.upsert_abha_link({
             #"emr_patient_id": state, --- IGNORE ---, using google name as ehr_patient_id
             "emr_patient_id": emr_patient_id,
             "abha_id": abha_id,
@@ -219,13 +279,13 @@ async def callback(request: Request, emr_client=Depends(authenticate_emr_client)
             "emr_client_id": emr_client["id"]
         })
 
-        log_event("abha_link_completed",
+        await db.log_event("abha_link_completed",
                 #state, --- IGNORE ---, using google name as ehr_patient_id
                 emr_patient_id,
                     {
             "abha_id": abha_id,
             "expires_at": expires_at
-        })
+        }, emr_client["id"])
 
         # return JSONResponse({"status": "linked", "ehr_patient_id": state, "abha_id": abha_id})
         return JSONResponse({"status": "linked", "emr_patient_id": emr_patient_id, "abha_id": abha_id})
@@ -237,8 +297,8 @@ async def callback(request: Request, emr_client=Depends(authenticate_emr_client)
     
 # 3) Check status (decrypt tokens before returning)
 @router.get("/status/{emr_patient_id}")
-async def status(emr_patient_id: str, ):
-    rec = get_abha_link(emr_patient_id)
+async def status(emr_patient_id: str, db: DataSession = Depends(get_data_session)):
+    rec = await db.get_abha_link(emr_patient_id)
     if not rec:
         raise HTTPException(status_code=404, detail="Not linked")
     try:
@@ -251,35 +311,35 @@ async def status(emr_patient_id: str, ):
 
 # 4) Refresh token
 @router.post("/refresh/{emr_patient_id}")
-async def refresh(emr_patient_id: str, emr_client=Depends(authenticate_emr_client)):
-    rec = get_abha_link(emr_patient_id)
+async def refresh(emr_patient_id: str, emr_client=Depends(authenticate_emr_client),
+                  db: DataSession = Depends(get_data_session)):
+    rec = await db.get_abha_link(emr_patient_id)
     if not rec:
         raise HTTPException(status_code=404, detail="Not linked")
     refresh_token = decrypt_value(rec["refresh_token"])
     # manual token refresh via Authlib
-    client = oauth.create_client("abha")
+    client = get_oauth().create_client("abha")
     # new_token = await client.fetch_access_token(ABHA_TOKEN_URL, grant_type="refresh_token", refresh_token=refresh_token) ---use when using ABDM---
     new_token = await client.fetch_access_token("https://oauth2.googleapis.com/token", grant_type="refresh_token", refresh_token=refresh_token)
     enc_access = encrypt_value(new_token["access_token"])
     enc_refresh = encrypt_value(new_token.get("refresh_token", refresh_token))
     expires_at = int(time.time()) + new_token.get("expires_in", 3600)
-    update_abha_link(emr_patient_id, {
+    await db.update_abha_link(emr_patient_id, {
         "access_token": enc_access,
         "refresh_token": enc_refresh,
         "expires_at": expires_at
     })
 
     
-    log_event("abha_token_refreshed", emr_patient_id, {
+    await db.log_event("abha_token_refreshed", emr_patient_id, {
         "expires_at": expires_at
-    })
+    }, emr_client["id"])
 
     return {"status": "refreshed", "emr_patient_id": emr_patient_id}
 
 
 # 5) Audit logs for a patient (for DEV only; secure in production)
 @router.get("/audit/{emr_patient_id}")
-async def get_audit_log(emr_patient_id: str):
-    logs = supabase.table("audit_logs").select("*").eq("emr_patient_id", emr_patient_id).order("timestamp", desc=True).execute()
-    return logs.data
+async def get_audit_log(emr_patient_id: str, db: DataSession = Depends(get_data_session)):
+    return await db.get_audit_logs(emr_patient_id)
 
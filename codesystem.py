@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from fastjson import dumps
+
+NAMASTE_SYSTEM = "http://example.org/fhir/CodeSystem/namaste"
+
+CONCEPT_QUERY = """
+SELECT NAMC_CODE, NAMC_term, "NAMC _term_diacritical", "  NAMC _term_DEVANAGARI",
+       short_definition, long_definition, ontology_branches
+FROM namaste_terms
+WHERE NAMC_CODE IS NOT NULL
+"""
+
+
+def _clean(value):
+    if value is None:
+        return ""
+    return str(value).strip()
+
+
+def build_concept(code, term, diacritical, devanagari, short_def, long_def, branches) -> dict:
+    """One CodeSystem.concept from a namaste_terms row."""
+    concept = {"code": _clean(code), "display": _clean(term)}
+    # long_definition is often blank; fall back to the short one
+    definition = _clean(long_def) or _clean(short_def)
+    if definition:
+        concept["definition"] = definition
+    designation = []
+    if _clean(diacritical):
+        designation.append({"language": "sa-Latn", "value": _clean(diacritical)})
+    if _clean(devanagari):
+        designation.append({"language": "sa-Deva", "value": _clean(devanagari)})
+    if designation:
+        concept["designation"] = designation
+    prop = []
+    if _clean(short_def):
+        prop.append({"code": "short-definition", "valueString": _clean(short_def)})
+    if _clean(branches):
+        prop.append({"code": "ontology-branch", "valueString": _clean(branches)})
+    if prop:
+        concept["property"] = prop
+    return concept
+
+
+def codesystem_envelope(version, count, date=None):
+    """(prefix, suffix) bytes that wrap the comma-joined encoded concepts (date: today)."""
+    head = dumps({
+        "resourceType": "CodeSystem",
+        "id": "namaste",
+        "url": NAMASTE_SYSTEM,
+        "version": version,
+        "name": "NAMASTE",
+        "status": "active",
+        "date": date or datetime.now().date().isoformat(),
+        "content": "complete",
+        "count": count,
+    })
+    return head[:-1] + b',"concept":[', b"]}"
@@ -0,0 +1,192 @@
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime
+
+from codesystem import NAMASTE_SYSTEM
+from fastjson import dumps
+
+TM2_SYSTEM = "http://who.int/icd11/tm2"
+CONCEPTMAP_URL = "http://example.org/fhir/ConceptMap/namaste-tm2"
+
+# One row per NAMASTE code that has a TM2 target. tm2_entities has several rows per
+# TM2 code (one per index term), so collapse it to a single title first.
+ELEMENT_QUERY = """
+SELECT m.NAMC_CODE, m.NAMC_term, m."TM2 Code", m.Similarity_Score, t.title
+FROM mapped_terms m
+LEFT JOIN (SELECT "TM2 Code" AS code, MIN(Title) AS title FROM tm2_entities GROUP BY "TM2 Code") t
+  ON t.code = m."TM2 Code"
+WHERE m.NAMC_CODE IS NOT NULL AND m."TM2 Code" IS NOT NULL
+"""
+
+# keep IN (...) lists under SQLite's default host parameter limit
+MAX_PARAMS = 500
+
+
+def build_element(namc_code, namc_term, tm2_code, similarity, tm2_title) -> dict:
+    target = {"code": tm2_code, "equivalence": "equivalent"}
+    if tm2_title:
+        target["display"] = tm2_title
+    if similarity is not None:
+        target["comment"] = f"similarity {float(similarity):.2f}"
+    element = {"code": namc_code}
+    if namc_term:
+        element["display"] = namc_term
+    element["target"] = [target]
+    return element
+
+
+def conceptmap_envelope(version, date=None):
+    """(prefix, suffix) bytes that wrap the comma-joined encoded elements (date: today)."""
+    head = dumps({
+        "resourceType": "ConceptMap",
+        "id": "namaste-tm2",
+        "url": CONCEPTMAP_URL,
+        "version": version,
+        "name": "NamasteToTM2",
+        "status": "active",
+        "date": date or datetime.now().date().isoformat(),
+    })
+    group = dumps({"source": NAMASTE_SYSTEM, "target": TM2_SYSTEM})
+    return head[:-1] + b',"group":[' + group[:-1] + b',"element":[', b"]}]}"
+
+
+class ConceptMapCache:
+    """NAMASTE -> TM2 ConceptMap generated from mapped_terms.
+
+    Each group.element is kept as encoded JSON bytes keyed by NAMC code, so a mapping
+    change only re-encodes the affected elements. The assembled document is cached
+    until the next change.
+    """
+
+    def __init__(self, conn, version="1.0.0"):
+        self.conn = conn
+        self.version = version
+        self._elements = {}  # NAMC code -> encoded element
+        self._order = []     # sorted NAMC codes
+        self._by_tm2 = {}    # TM2 code -> set of NAMC codes
+        self._tm2_of = {}    # NAMC code -> TM2 code
+        self._body = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._order)
+
+    # ---------- materialization ----------
+    def load(self):
+        """Rebuild every element from the database."""
+        rows = self.conn.execute(ELEMENT_QUERY).fetchall()
+        with self._lock:
+            self._elements.clear()
+            self._by_tm2.clear()
+            self._tm2_of.clear()
+            for row in rows:
+                self._put(row)
+            self._order = sorted(self._elements)
+            self._body = None
+
+    def refresh(self, namc_codes=(), tm2_codes=()):
+        """Re-materialize only the elements touched by the given codes.
+
+        Pass NAMC codes whose mapping row was inserted, changed or deleted, and TM2
+        codes whose title changed. Returns the number of elements rebuilt or removed.
+        """
+        namc_codes = set(namc_codes)
+        tm2_codes = set(tm2_codes)
+        if not namc_codes and not tm2_codes:
+            return 0
+
+        rows = []
+        for column, codes in (("m.NAMC_CODE", namc_codes), ('m."TM2 Code"', tm2_codes)):
+            codes = list(codes)
+            for i in range(0, len(codes), MAX_PARAMS):
+                chunk = codes[i:i + MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(self.conn.execute(
+                    f"{ELEMENT_QUERY} AND {column} IN ({placeholders})", chunk
+                ).fetchall())
+
+        with self._lock:
+            seen = set()
+            for row in rows:
+                if row[0] in seen:
+                    continue
+                seen.add(row[0])
+                if row[0] not in self._elements:
+                    insort(self._order, row[0])
+                self._put(row)
+            # requested NAMC codes that no longer have a TM2 target
+            for code in namc_codes - seen:
+                if code in self._elements:
+                    self._drop(code)
+            self._body = None
+        return len(seen) + len(namc_codes - seen)
+
+    def advance(self, version, namc_codes=()):
+        """Move to a newer release, rebuilding only the elements whose mapping changed."""
+        self.refresh(namc_codes=namc_codes)
+        with self._lock:
+            self.version = version
+            self._body = None
+
+    def _put(self, row):
+        code, tm2_code = row[0], row[2]
+        old_tm2 = self._tm2_of.get(code)
+        if old_tm2 is not None and old_tm2 != tm2_code:
+            self._by_tm2[old_tm2].discard(code)
+        self._tm2_of[code] = tm2_code
+        self._by_tm2.setdefault(tm2_code, set()).add(code)
+        self._elements[code] = dumps(build_element(*row))
+
+    def _drop(self, code):
+        del self._elements[code]
+        self._order.pop(bisect_left(self._order, code))
+        tm2_code = self._tm2_of.pop(code, None)
+        if tm2_code is not None:
+            self._by_tm2[tm2_code].discard(code)
+
+    def encoded_elements(self):
+        """(NAMC code, encoded element) pairs in code order."""
+        with self._lock:
+            return [(c, self._elements[c]) for c in self._order]
+
+    # ---------- encoding ----------
+    def _envelope(self, version):
+        return conceptmap_envelope(version or self.version)
+
+    def body(self, version=None) -> bytes:
+        """The full ConceptMap as UTF-8 JSON bytes."""
+        with self._lock:
+            if version is None and self._body is not None:
+                return self._body
+            prefix, suffix = self._envelope(version)
+            body = prefix + b",".join(self._elements[c] for c in self._order) + suffix
+            if version is None:
+                self._body = body
+            return body
+
+    def iter_chunks(self, version=None, chunk_size=64 * 1024):
+        """Yield the ConceptMap in pieces of roughly chunk_size bytes."""
+        with self._lock:
+            if version is None and self._body is not None:
+                body = self._body
+            else:
+                body = None
+                elements = [self._elements[c] for c in self._order]
+        if body is not None:
+            for i in range(0, len(body), chunk_size):
+                yield body[i:i + chunk_size]
+            return
+
+        prefix, suffix = self._envelope(version)
+        buf = [prefix]
+        size = len(prefix)
+        for i, element in enumerate(elements):
+            if i:
+                buf.append(b",")
+            buf.append(element)
+            size += len(element) + 1
+            if size >= chunk_size:
+                yield b"".join(buf)
+                buf, size = [], 0
+        buf.append(suffix)
+        yield b"".join(buf)
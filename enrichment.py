@@ -0,0 +1,140 @@
+from admission import AdmissionDenied
+from codesystem import CONCEPT_QUERY, build_concept
+from conceptmap import TM2_SYSTEM
+from lru import LRU
+
+INDEX_TERM_URL = "http://example.org/fhir/extension/index-term"
+SHORT_DEFINITION_URL = "http://example.org/fhir/extension/short-definition"
+LONG_DEFINITION_URL = "http://example.org/fhir/extension/long-definition"
+TM2_DEFINITION_URL = "http://example.org/fhir/extension/tm2-definition"
+
+
+class Enrichment:
+    """What /Bundle adds to a Condition for one NAMASTE code."""
+
+    __slots__ = ("code", "tm2_code", "tm2_coding", "extensions", "complete")
+
+    def __init__(self, code, tm2_code, tm2_coding, extensions, complete=True):
+        self.code = code
+        self.tm2_code = tm2_code
+        self.tm2_coding = tm2_coding  # TM2 Coding to append when missing
+        self.extensions = extensions  # url -> extension, in the order they are appended
+        self.complete = complete      # False when the WHO details could not be fetched
+
+
+class EnrichmentCache:
+    """Per-NAMC-code Condition enrichment, built lazily and LRU-evicted.
+
+    An entry bundles the TM2 coding and the index-term / short-definition /
+    long-definition / tm2-definition extensions, so enriching a Condition is a dict
+    lookup and a merge. TM2 details come from `lookup` (biomed $lookup) and are cached
+    per TM2 code; entries whose WHO lookup failed are not cached so the next bundle
+    retries. AdmissionDenied from the lookup propagates (the caller should get a 429,
+    not a degraded Condition). Call invalidate() when mappings or WHO data change.
+    """
+
+    def __init__(self, conn, lookup, maxsize=4096):
+        self.conn = conn
+        self.lookup = lookup
+        self._entries = LRU(maxsize)
+        self._tm2 = LRU(maxsize)
+
+    def invalidate(self, namc_codes=None, tm2_codes=None):
+        """Drop the given codes, or everything when called without arguments."""
+        if namc_codes is None and tm2_codes is None:
+            self._entries.clear()
+            self._tm2.clear()
+            return
+        for code in namc_codes or ():
+            self._entries.pop(code)
+        tm2_codes = set(tm2_codes or ())
+        for code in tm2_codes:
+            self._tm2.pop(code)
+        if tm2_codes:
+            for code, entry in self._entries.items():
+                if entry.tm2_code in tm2_codes:
+                    self._entries.pop(code)
+
+    def tm2_details(self, tm2_code):
+        """(display, definition) for a TM2 code, or None if the lookup failed."""
+        details = self._tm2.get(tm2_code)
+        if details is not None:
+            return details
+        try:
+            data = self.lookup(tm2_code)
+        except AdmissionDenied:
+            raise
+        except Exception:
+            return None
+        details = (data.get("display") or "", data.get("definition") or "")
+        self._tm2.put(tm2_code, details)
+        return details
+
+    def get(self, code):
+        """Enrichment for a NAMC code, or None if it has no TM2 mapping."""
+        entry = self._entries.get(code)
+        if entry is not None:
+            return entry
+
+        row = self.conn.execute('SELECT "TM2 Code" FROM mapped_terms WHERE NAMC_CODE = ?', (code,)).fetchone()
+        if not row or not row[0]:
+            return None
+        tm2_code = row[0]
+        concept_row = self.conn.execute(CONCEPT_QUERY + " AND NAMC_CODE = ?", (code,)).fetchone()
+        concept = build_concept(*concept_row) if concept_row else None
+        details = self.tm2_details(tm2_code)
+
+        extensions = {}
+        if concept:
+            extensions[SHORT_DEFINITION_URL] = {"url": SHORT_DEFINITION_URL, "valueString": concept["display"]}
+            extensions[LONG_DEFINITION_URL] = {"url": LONG_DEFINITION_URL, "valueString": concept.get("definition", "")}
+            extensions[INDEX_TERM_URL] = {"url": INDEX_TERM_URL, "valueString": concept["display"]}
+        if details:
+            extensions[TM2_DEFINITION_URL] = {"url": TM2_DEFINITION_URL, "valueString": details[1]}
+        tm2_coding = {"system": TM2_SYSTEM, "code": tm2_code, "display": details[0] if details else ""}
+        entry = Enrichment(code, tm2_code, tm2_coding, extensions, complete=details is not None)
+
+        if details is not None:
+            self._entries.put(code, entry)
+        return entry
+
+
+def enrich_condition(condition, namaste_codes, cache, logger=None):
+    """Merge cached enrichment into a Condition in place.
+
+    Returns False if some TM2 details could not be fetched (the Condition is degraded).
+    Raises LookupError with the first NAMASTE code that has no TM2 mapping.
+    """
+    complete = True
+    coding = condition.setdefault("code", {}).setdefault("coding", [])
+    extensions = condition.get("extension", [])
+    present = {ext.get("url") for ext in extensions}
+    tm2_present = {c.get("code") for c in coding if c.get("system") == TM2_SYSTEM}
+
+    for code in namaste_codes:
+        entry = cache.get(code)
+        if entry is None:
+            raise LookupError(code)
+        complete = complete and entry.complete
+        if entry.tm2_code not in tm2_present:
+            coding.append(dict(entry.tm2_coding))
+            tm2_present.add(entry.tm2_code)
+            if logger and not entry.tm2_coding["display"]:
+                logger.warning(f"Could not fetch TM2 display for {entry.tm2_code}")
+        for url, ext in entry.extensions.items():
+            if url not in present:
+                extensions.append(dict(ext))
+                present.add(url)
+
+    # TM2 codings sent by the client that did not come from a NAMASTE mapping
+    if TM2_DEFINITION_URL not in present:
+        for c in coding:
+            if c.get("system") == TM2_SYSTEM:
+                details = cache.tm2_details(c.get("code"))
+                if details:
+                    extensions.append({"url": TM2_DEFINITION_URL, "valueString": details[1]})
+                    present.add(TM2_DEFINITION_URL)
+                    break
+
+    condition["extension"] = extensions
+    return complete
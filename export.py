@@ -0,0 +1,213 @@
+import csv
+import io
+import json
+import sqlite3
+import zlib
+
+from ingest import SCHEMAS
+
+# _type value -> live table it is exported from (CSV / Parquet)
+EXPORT_TABLES = {
+    "namaste": "namaste_terms",
+    "mapping": "mapped_terms",
+    "tm2": "tm2_entities",
+}
+# _type value -> terminology store kind (NDJSON)
+STORE_KINDS = {"namaste": "concept", "mapping": "mapping"}
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+FORMAT_ALIASES = {
+    "application/fhir+ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/x-ndjson": "ndjson",
+    "ndjson": "ndjson",
+    "text/csv": "csv",
+    "csv": "csv",
+    "application/parquet": "parquet",
+    "application/vnd.apache.parquet": "parquet",
+    "parquet": "parquet",
+}
+
+FETCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+PARQUET_ROW_GROUP = 10000
+
+
+def _open(db_path):
+    # a private read connection whose transaction pins one snapshot, so the export
+    # never sees half of a concurrent ingest; the database runs in WAL mode (see
+    # ingest.use_wal), so this reader does not block writers while a slow client
+    # drains the stream
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("BEGIN")
+    return conn
+
+
+def _fetch(conn, query, params=()):
+    cursor = conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def _buffered(pieces):
+    """Coalesce small byte pieces into chunks of about CHUNK_SIZE."""
+    buf, size = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield b"".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b"".join(buf)
+
+
+# ---------- NDJSON ----------
+def _ndjson_lines(conn, types, version):
+    for t in types:
+        tag = b'{"type":"' + t.encode("ascii") + b'",'
+        if t in STORE_KINDS:
+            # blobs are already the encoded concept / ConceptMap element
+            for (body,) in _fetch(conn, """
+                SELECT b.body FROM tx_release_items i JOIN tx_blobs b ON b.hash = i.hash
+                WHERE i.version = ? AND i.kind = ? ORDER BY i.code
+            """, (version, STORE_KINDS[t])):
+                yield tag + bytes(body)[1:] + b"\n"
+        else:
+            for entity_id, code, title, index_term in _fetch(
+                conn, 'SELECT "Entity ID", "TM2 Code", Title, IndexTerm FROM tm2_entities'
+            ):
+                record = {"type": "tm2", "entityId": entity_id, "code": code, "title": title}
+                if index_term:
+                    record["indexTerm"] = index_term
+                yield json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+# ---------- CSV ----------
+def _columns(table):
+    return [col for col, _ in SCHEMAS[table]]
+
+
+def _select(table):
+    return "SELECT " + ", ".join('"' + col + '"' for col in _columns(table)) + f" FROM {table}"
+
+
+def _csv_pieces(conn, table):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(_columns(table))
+    for i, row in enumerate(_fetch(conn, _select(table)), start=1):
+        writer.writerow(row)
+        if i % FETCH_SIZE == 0:
+            yield out.getvalue().encode("utf-8")
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue().encode("utf-8")
+
+
+# ---------- Parquet ----------
+class _Sink(io.RawIOBase):
+    """Write target for ParquetWriter that hands back whatever was written so far."""
+
+    def __init__(self):
+        self._pieces = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._pieces.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._pieces)
+        self._pieces = []
+        return data
+
+
+def _parquet_pieces(conn, table):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+    schema = pa.schema([(col, types[typ]) for col, typ in SCHEMAS[table]])
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    rows = []
+
+    def flush():
+        columns = list(zip(*rows))
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+            schema=schema,
+        ))
+        rows.clear()
+        return sink.drain()
+
+    for row in _fetch(conn, _select(table)):
+        rows.append(row)
+        if len(rows) >= PARQUET_ROW_GROUP:
+            yield flush()
+    if rows:
+        yield flush()
+    writer.close()
+    yield sink.drain()
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# ---------- entry point ----------
+def export_stream(db_path, types, fmt, version=None, encoding=None):
+    """Yield the export as byte chunks, optionally gzip/deflate compressed.
+
+    NDJSON is read from the terminology store at `version`; CSV and Parquet export a
+    single table from the loaded snapshot.
+    """
+    conn = _open(db_path)
+    try:
+        if fmt == "ndjson":
+            pieces = _ndjson_lines(conn, types, version)
+        elif fmt == "csv":
+            pieces = _csv_pieces(conn, EXPORT_TABLES[types[0]])
+        else:
+            pieces = _parquet_pieces(conn, EXPORT_TABLES[types[0]])
+
+        if encoding is None:
+            yield from _buffered(pieces)
+            return
+        # gzip: wbits 31, zlib/deflate: 15
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+        for chunk in _buffered(pieces):
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        conn.close()
+
+
+def pick_encoding(accept_encoding):
+    """gzip or deflate if the client accepts it, else None."""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in ("gzip", "deflate"):
+        if encoding in accepted:
+            return encoding
+    return None
@@ -0,0 +1,89 @@
+import gzip
+import json
+
+from fastapi.responses import Response
+
+from lru import LRU
+
+try:
+    import orjson
+except ImportError:  # stdlib fallback; same output, just slower
+    orjson = None
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """JSON response rendered with orjson when available.
+
+    Returning one of these (or raw_json bytes) from an endpoint skips FastAPI's
+    jsonable_encoder / response_model validation, so only use it for data we built.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def raw_json(body: bytes, **kwargs) -> Response:
+    """Response for bytes that are already encoded JSON."""
+    return Response(body, media_type="application/json", **kwargs)
+
+
+class FragmentCache:
+    """Bounded map of hashable key -> encoded JSON fragment.
+
+    Keys are the values the fragment is built from, so entries never go stale; they
+    only fall out when the cache is full.
+    """
+
+    def __init__(self, maxsize=4096):
+        self._fragments = LRU(maxsize)
+
+    def get(self, key, build):
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            fragment = build(*key)
+            self._fragments.put(key, fragment)
+        return fragment
+
+
+def accepts_gzip(request) -> bool:
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.partition(";")
+        if name.strip().lower() == "gzip" and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            return True
+    return False
+
+
+class CompressedBodies:
+    """gzip copies of large, cached response bodies (CodeSystem, ConceptMap).
+
+    An entry is reused only while the caller still hands in the very same bytes
+    object, so rebuilding a body invalidates its compressed copy automatically.
+    """
+
+    def __init__(self, maxsize=16, level=6):
+        self.level = level
+        self._entries = LRU(maxsize)  # key -> (body, gzip(body))
+
+    def get(self, key, body: bytes) -> bytes:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is body:
+            return entry[1]
+        compressed = gzip.compress(body, self.level)
+        self._entries.put(key, (body, compressed))
+        return compressed
+
+    def response(self, request, key, body: bytes):
+        """Serve body gzip-encoded when the client accepts it."""
+        headers = {"Vary": "Accept-Encoding"}
+        if accepts_gzip(request):
+            headers["Content-Encoding"] = "gzip"
+            return raw_json(self.get(key, body), headers=headers)
+        return raw_json(body, headers=headers)
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+def content_hash(bundle: dict) -> str:
+    """sha256 of the bundle in canonical JSON (sorted keys, no whitespace)."""
+    canonical = json.dumps(bundle, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return "sha256:" + hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """Recent /Bundle results keyed by Idempotency-Key (or content hash), in SQLite.
+
+    Bounded by max_entries and ttl seconds. Requests for the same key are serialized
+    in-process, so a retry that arrives while the original is still running waits for
+    it and replays its result instead of enriching and inserting again.
+    """
+
+    def __init__(self, conn, max_entries=10000, ttl=24 * 3600):
+        self.conn = conn
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._locks = {}  # key -> [lock, waiters]
+        self._locks_guard = threading.Lock()
+        self._writes = 0
+
+    def ensure_schema(self):
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS bundle_idempotency (
+            key TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            response BLOB NOT NULL,
+            created_at REAL NOT NULL
+        )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_bundle_idempotency_created ON bundle_idempotency (created_at)")
+        self.conn.commit()
+
+    @contextmanager
+    def lock(self, key):
+        with self._locks_guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def get(self, key):
+        """(content_hash, response bytes) stored for key, or None."""
+        row = self.conn.execute(
+            "SELECT content_hash, response FROM bundle_idempotency WHERE key = ? AND created_at >= ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+        return (row[0], bytes(row[1])) if row else None
+
+    def put(self, key, content_hash, response: bytes):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO bundle_idempotency (key, content_hash, response, created_at) VALUES (?, ?, ?, ?)",
+            (key, content_hash, response, time.time()),
+        )
+        self.conn.commit()
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def prune(self):
+        self.conn.execute("DELETE FROM bundle_idempotency WHERE created_at < ?", (time.time() - self.ttl,))
+        self.conn.execute("""
+        DELETE FROM bundle_idempotency WHERE key IN (
+            SELECT key FROM bundle_idempotency ORDER BY created_at DESC LIMIT -1 OFFSET ?
+        )""", (self.max_entries,))
+        self.conn.commit()
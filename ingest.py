@@ -0,0 +1,310 @@
+"""Load NAMASTE / TM2 source files into terminology.db.
+
+Rows are streamed from the Ayurveda morbidity-code workbook (or a CSV export of it)
+and the mapped_terms / tm2_entities CSVs, coerced to explicit column types,
+normalized and written in batches into the tables the API queries. The result is
+recorded as a release in the versioned terminology store; on re-ingest only the
+inserted / changed / removed codes are reported.
+
+    python ingest.py --namaste 881207232-National-Ayurveda-Morbidity-Codes-v-1-0.xlsx --version 1.0
+"""
+import argparse
+import csv
+import logging
+import os
+import re
+import sqlite3
+import sys
+import unicodedata
+
+from conceptmap import ConceptMapCache
+from terminology_store import TerminologyStore
+
+logger = logging.getLogger("uvicorn.error")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOURCES = {
+    "namaste_terms": os.path.join(BASE_DIR, "881207232-National-Ayurveda-Morbidity-Codes-v-1-0.xlsx"),
+    "mapped_terms": os.path.join(BASE_DIR, "mapped_terms.csv"),
+    "tm2_entities": os.path.join(BASE_DIR, "tm2_entities.csv"),
+}
+BATCH_SIZE = 1000
+
+# table -> (column, type) in table order; column names are the ones main.py queries
+SCHEMAS = {
+    "namaste_terms": [
+        ("NAMC_ID", int),
+        ("NAMC_CODE", str),
+        ("NAMC_term", str),
+        ("NAMC _term_diacritical", str),
+        ("  NAMC _term_DEVANAGARI", str),
+        ("short_definition", str),
+        ("long_definition", str),
+        ("ontology_branches", str),
+    ],
+    "mapped_terms": [
+        ("NAMC_CODE", str),
+        ("NAMC_term", str),
+        ("NAMC _term_diacritical", str),
+        ("Matched_IndexTerm", str),
+        ("short_definition", str),
+        ("long_definition", str),
+        ("TM2 Code", str),
+        ("Similarity_Score", float),
+    ],
+    "tm2_entities": [
+        ("Entity ID", int),
+        ("TM2 Code", str),
+        ("Title", str),
+        ("IndexTerm", str),
+    ],
+}
+# column that must be present (and, if unique, not repeated) for a row to be kept
+KEYS = {
+    "namaste_terms": ("NAMC_CODE", True),
+    "mapped_terms": ("NAMC_CODE", True),
+    "tm2_entities": ("Entity ID", False),
+}
+INDEXES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_namaste_code ON namaste_terms (NAMC_CODE)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_mapped_code ON mapped_terms (NAMC_CODE)',
+    'CREATE INDEX IF NOT EXISTS idx_mapped_tm2 ON mapped_terms ("TM2 Code")',
+    'CREATE INDEX IF NOT EXISTS idx_tm2_code ON tm2_entities ("TM2 Code")',
+]
+SQL_TYPES = {int: "INTEGER", float: "REAL", str: "TEXT"}
+# blanks left behind by pandas exports; "NA" is a real NAMASTE code so it is kept
+NULL_STRINGS = {"", "nan", "NaN"}
+
+
+class RowError(ValueError):
+    pass
+
+
+def _header_key(name) -> str:
+    # headers drift between exports ("NAMC _term_diacritical", "  NAMC _term_DEVANAGARI", BOM)
+    return re.sub(r"[\s\ufeff]+", "", str(name or "")).lower()
+
+
+# ---------- readers ----------
+def iter_csv(path):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        yield from csv.reader(f)
+
+
+def iter_xlsx(path, sheet=None):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("openpyxl is required to read .xlsx sources (pip install openpyxl)")
+    # read_only streams rows from the sheet XML instead of loading the workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        yield from ws.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def iter_source(path, sheet=None):
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        return iter_xlsx(path, sheet)
+    return iter_csv(path)
+
+
+# ---------- validation / normalization ----------
+def _coerce(value, typ):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = unicodedata.normalize("NFC", value).strip()
+        if value in NULL_STRINGS:
+            return None
+    if typ is str:
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value)
+    if typ is int:
+        number = float(value)
+        if not number.is_integer():
+            raise RowError(f"expected an integer, got {value!r}")
+        return int(number)
+    return float(value)
+
+
+def iter_records(table, rows):
+    """Validated, typed tuples in SCHEMAS[table] column order.
+
+    Yields (record, None) or (None, error message) so callers can count rejects
+    without stopping the stream.
+    """
+    schema = SCHEMAS[table]
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    positions = {_header_key(h): i for i, h in enumerate(header)}
+    missing = [col for col, _ in schema if _header_key(col) not in positions]
+    if missing:
+        raise RuntimeError(f"{table}: source is missing columns {missing}")
+    index = [(positions[_header_key(col)], col, typ) for col, typ in schema]
+    key_col, unique = KEYS[table]
+    key_pos = [col for _, col, _ in index].index(key_col)
+    seen = set()
+
+    for line, row in enumerate(rows, start=2):
+        if not any(v not in (None, "") for v in row):
+            continue
+        try:
+            record = tuple(
+                _coerce(row[pos] if pos < len(row) else None, typ)
+                for pos, col, typ in index
+            )
+        except (RowError, ValueError) as e:
+            yield None, f"{table} row {line}: {e}"
+            continue
+        key = record[key_pos]
+        if key is None:
+            yield None, f"{table} row {line}: missing {key_col}"
+            continue
+        if unique:
+            if key in seen:
+                yield None, f"{table} row {line}: duplicate {key_col} {key}"
+                continue
+            seen.add(key)
+        if table == "mapped_terms":
+            score = record[-1]
+            if score is not None and not 0 <= score <= 100:
+                yield None, f"{table} row {line}: Similarity_Score {score} out of range"
+                continue
+        yield record, None
+
+
+# ---------- load ----------
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def load_table(conn, table, rows):
+    """Stream rows into <table>_new in batches, then swap it in. Returns (loaded, rejected)."""
+    schema = SCHEMAS[table]
+    staging = f"{table}_new"
+    columns = ", ".join(f"{_quote(col)} {SQL_TYPES[typ]}" for col, typ in schema)
+    placeholders = ", ".join("?" * len(schema))
+    conn.execute(f"DROP TABLE IF EXISTS {staging}")
+    conn.execute(f"CREATE TABLE {staging} ({columns})")
+
+    loaded, rejected, batch = 0, 0, []
+    for record, error in iter_records(table, rows):
+        if error:
+            rejected += 1
+            logger.warning(error)
+            continue
+        batch.append(record)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(f"INSERT INTO {staging} VALUES ({placeholders})", batch)
+            loaded += len(batch)
+            batch = []
+    if batch:
+        conn.executemany(f"INSERT INTO {staging} VALUES ({placeholders})", batch)
+        loaded += len(batch)
+    return loaded, rejected
+
+
+def use_wal(conn):
+    """Switch the database to WAL so readers (e.g. a long $export) never block writers.
+
+    The journal mode is stored in the file, so this only has to succeed once.
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+
+
+def ingest(conn, sources=None, version=None, sheet=None, store=None, conceptmap_cache=None):
+    """Load all sources, rebuild indexes and record a terminology release.
+
+    Returns {"tables": {table: {"loaded", "rejected"}}, "release": store summary or None}.
+    """
+    sources = {**DEFAULT_SOURCES, **(sources or {})}
+    use_wal(conn)
+    store = store or TerminologyStore(conn)
+    store.ensure_schema()  # executescript commits, so it has to run before the load
+    conceptmap_cache = conceptmap_cache or ConceptMapCache(conn)
+    stats = {}
+    for table in SCHEMAS:
+        loaded, rejected = load_table(conn, table, iter_source(sources[table], sheet if table == "namaste_terms" else None))
+        stats[table] = {"loaded": loaded, "rejected": rejected}
+
+    # swap all three tables and record the release in one transaction, so the API
+    # never sees a mix and a rejected release (version conflict) leaves the old
+    # tables live; store.commit() commits or rolls back the whole thing
+    if not conn.in_transaction:
+        conn.execute("BEGIN")
+    for table in SCHEMAS:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    for statement in INDEXES:
+        conn.execute(statement)
+    conn.execute('CREATE TABLE IF NOT EXISTS biomed_codes (code TEXT PRIMARY KEY, title TEXT, definition TEXT)')
+    try:
+        conceptmap_cache.load()
+        release = store.snapshot_tables(conceptmap_cache, version)
+    except Exception:
+        conn.rollback()
+        for table in SCHEMAS:
+            conn.execute(f"DROP TABLE IF EXISTS {table}_new")
+        conn.commit()
+        conceptmap_cache.load()  # back to the tables that are still live
+        raise
+    conceptmap_cache.version = store.latest()
+    return {"tables": stats, "release": release}
+
+
+def _report(result):
+    for table, s in result["tables"].items():
+        print(f"{table}: {s['loaded']} rows loaded, {s['rejected']} rejected")
+    release = result["release"]
+    if release is None:
+        print("No changes since the latest release")
+        return
+    if release["repointed"]:
+        print(f"Release {release['version']} already holds this content; it is the latest release again "
+              f"(previous: {release['previous']})")
+    else:
+        print(f"Release {release['version']} (previous: {release['previous']})")
+    for kind, label in (("concept", "NAMASTE concepts"), ("mapping", "NAMASTE->TM2 mappings")):
+        changes = release[kind]
+        print(f"{label}: {len(changes['added'])} inserted, {len(changes['changed'])} changed, "
+              f"{len(changes['removed'])} removed")
+        # a first ingest inserts everything; only list codes on re-ingest
+        if release["previous"]:
+            for what in ("added", "changed", "removed"):
+                if changes[what]:
+                    print(f"  {what}: {', '.join(changes[what])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest NAMASTE / TM2 terminology into terminology.db")
+    parser.add_argument("--db", default="terminology.db")
+    parser.add_argument("--namaste", default=DEFAULT_SOURCES["namaste_terms"], help=".xlsx workbook or .csv export")
+    parser.add_argument("--sheet", default=None, help="workbook sheet (default: first)")
+    parser.add_argument("--mapped", default=DEFAULT_SOURCES["mapped_terms"])
+    parser.add_argument("--tm2", default=DEFAULT_SOURCES["tm2_entities"])
+    parser.add_argument("--version", default=None, help="release version (default: content hash)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(args.db)
+    try:
+        result = ingest(conn, {
+            "namaste_terms": args.namaste,
+            "mapped_terms": args.mapped,
+            "tm2_entities": args.tm2,
+        }, version=args.version, sheet=args.sheet)
+    except ValueError as e:
+        sys.exit(f"Ingest aborted, live tables unchanged: {e}")
+    finally:
+        conn.close()
+    _report(result)
+
+
+if __name__ == "__main__":
+    main()
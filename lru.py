@@ -0,0 +1,44 @@
+import threading
+from collections import OrderedDict
+
+
+class LRU:
+    """Thread-safe bounded map; the least recently used entries fall out first.
+
+    None is not a storable value: get() and pop() return None for a missing key.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def items(self):
+        """Snapshot of (key, value) pairs, oldest first."""
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
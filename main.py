@@ -1,70 +1,261 @@
+import asyncio
+import hmac
 import sqlite3
-import pandas as pd
-from fastapi import FastAPI, Query, HTTPException
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, Query, HTTPException, Request, Header, Depends
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
-import json
 import requests
 import logging
 from datetime import datetime
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 import os
-from auth import router as auth_router
+from auth import API_KEY, router as auth_router, cached_emr_client, optional_security, warm_oauth
+from async_db import get_client as get_async_supabase
+from codesystem import NAMASTE_SYSTEM
+from conceptmap import ConceptMapCache
+from terminology_store import TerminologyStore
+from ingest import ingest, use_wal
+from fastjson import CompressedBodies, FastJSONResponse, FragmentCache, dumps, raw_json
+from enrichment import EnrichmentCache, enrich_condition
+from idempotency import IdempotencyStore, content_hash
+from admission import AdmissionController, AdmissionDenied, current_client, retry_after_header
+from profiling import Profiler, ProfilingMiddleware, span
+from export import EXPORT_TABLES, FORMATS, FORMAT_ALIASES, export_stream, parquet_available, pick_encoding
 from dotenv import load_dotenv
 load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")  
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-app = FastAPI()
+# Opt-in slow-request tracing (PROFILE_ENABLED=1); off, nothing is wrapped
+profiler = Profiler.from_env()
+
+# DB setup
+DB_PATH = 'terminology.db'
+conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=profiler.connection_factory())
+logger = logging.getLogger("uvicorn.error")
+# ConceptMap materialized from mapped_terms (same data $translate uses)
+conceptmap_cache = ConceptMapCache(conn)
+# every loaded release, served through _history and $diff
+store = TerminologyStore(conn)
+# gzip copies of the CodeSystem / ConceptMap bodies
+compressed_bodies = CompressedBodies()
+# per-NAMC-code TM2 coding + extensions for /Bundle (biomed_lookup is defined below)
+enrichment_cache = EnrichmentCache(conn, lambda code: biomed_lookup(code=code))
+# recent /Bundle results, replayed for EMR retries
+idempotency = IdempotencyStore(
+    conn,
+    max_entries=int(os.getenv("BUNDLE_IDEMPOTENCY_MAX", "10000")),
+    ttl=int(os.getenv("BUNDLE_IDEMPOTENCY_TTL", str(24 * 3600))),
+)
+
+# Startup: load the indexed terminology snapshot (run `python ingest.py` to refresh it).
+# Each phase is timed; outbound clients (OAuth metadata, async Supabase) are warmed in
+# the background so a slow or unreachable upstream never delays serving.
+WARM_CLIENTS = os.getenv("STARTUP_WARM_CLIENTS", "1") == "1"
+
+def _timed(timings, name, fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    timings[name] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+async def _warm(timings, name, connect):
+    started = time.perf_counter()
+    try:
+        await connect()
+    except Exception as e:
+        logger.warning(f"Startup warm-up {name} failed: {e}")
+        return
+    timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+def _load_terminology(timings):
+    has_terms = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'namaste_terms'"
+    ).fetchone()
+    # WAL: $export readers must not lock out /sync, lookups and idempotency writes
+    _timed(timings, "schema", lambda: (use_wal(conn), store.ensure_schema(), idempotency.ensure_schema(),
+                                       idempotency.prune()))
+    if not has_terms:
+        # fresh database: ingest the bundled workbook / CSVs
+        result = _timed(timings, "ingest", ingest, conn, version=os.getenv("TERMINOLOGY_VERSION"),
+                        store=store, conceptmap_cache=conceptmap_cache)
+        logger.info(f"Ingested terminology: {result['tables']}")
+    else:
+        _timed(timings, "conceptmap", conceptmap_cache.load)
+        conceptmap_cache.version = store.latest()
+    _timed(timings, "enrichment", enrichment_cache.invalidate)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    timings = {"phases": {}, "warmup": {}}
+    app.state.startup_timings = timings
+    warmups = []
+    if WARM_CLIENTS:
+        warmups = [
+            asyncio.create_task(_warm(timings["warmup"], "oauth_metadata", warm_oauth)),
+            asyncio.create_task(_warm(timings["warmup"], "supabase", get_async_supabase)),
+        ]
+    # SQLite work runs off the event loop so the warm-ups overlap with it
+    await asyncio.to_thread(_load_terminology, timings["phases"])
+    timings["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"Startup finished in {timings['total_ms']} ms: {timings['phases']}")
+    yield
+    for task in warmups:
+        task.cancel()
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 # secret key for session signing
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("SESSION_SECRET_KEY"))
+# compresses small/medium JSON; large cached bodies and $export set their own Content-Encoding
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=5)
+if profiler.enabled:
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
 
 
 app.include_router(auth_router, prefix="/abha")
 
+# Admission control for endpoints that can fan out to WHO / Supabase
+admission = AdmissionController.from_env()
+
+@app.exception_handler(AdmissionDenied)
+async def admission_denied_handler(request: Request, exc: AdmissionDenied):
+    return JSONResponse(status_code=429, content={"detail": exc.reason},
+                        headers={"Retry-After": retry_after_header(exc)})
+
+@contextmanager
+def _credential_check(address):
+    # an uncached credential check reads emr_clients from Supabase: charge the caller's
+    # address first, so bad credentials are rate limited like any anonymous request
+    admission.admit(address)
+    with admission.upstream("supabase", client=address):
+        yield
+
+async def admit_caller(request: Request, credentials=Depends(optional_security)):
+    # EMR clients are charged by emr_clients.id, anonymous callers by address
+    address = f"anon:{request.client.host if request.client else 'unknown'}"
+    emr_client = None
+    if credentials is not None:
+        emr_client = await cached_emr_client(credentials, guard=lambda: _credential_check(address))
+    client = f"emr:{emr_client['id']}" if emr_client else address
+    admission.admit(client)
+    current_client.set(client)
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the NAMASTE Terminology API"}
 
-# DB setup
-conn = sqlite3.connect('terminology.db', check_same_thread=False)
-logger = logging.getLogger("uvicorn.error")
+@app.get("/_startup")
+def startup_timings(request: Request):
+    # per-phase startup timings (ms); warm-up entries appear once each client is ready
+    return request.app.state.startup_timings
+
+def _require_admin(x_api_key: str = Header(None, alias="X-API-Key")):
+    if not profiler.enabled:
+        raise HTTPException(404, "Profiling is disabled (set PROFILE_ENABLED=1)")
+    if not API_KEY or not x_api_key or not hmac.compare_digest(x_api_key, API_KEY):
+        raise HTTPException(403, "Admin API key required")
 
-# Startup: load CSVs
-@app.on_event("startup")
-def startup_event():
-    namaste_df = pd.read_csv('nexevo_medi\\namaste_terms.csv')
-    mapped_df = pd.read_csv('nexevo_medi\\mapped_terms.csv')
-    tm2_df = pd.read_csv('nexevo_medi\\tm2_entities.csv')
-    conn.execute('''CREATE TABLE IF NOT EXISTS biomed_codes (code TEXT PRIMARY KEY, title TEXT, definition TEXT)''')
-    namaste_df.to_sql('namaste_terms', conn, if_exists='replace')
-    mapped_df.to_sql('mapped_terms', conn, if_exists='replace')
-    tm2_df.to_sql('tm2_entities', conn, if_exists='replace')
+@app.get("/_profile/slow", dependencies=[Depends(_require_admin)])
+def slow_traces(limit: int = Query(20, ge=1)):
+    # newest first: span timings + sampled stacks of requests over PROFILE_SLOW_MS
+    return {"slow_ms": profiler.slow_ms, "traces": profiler.recent(limit)}
+
+@app.delete("/_profile/slow", dependencies=[Depends(_require_admin)])
+def clear_slow_traces():
+    profiler.clear()
+    return {"status": "cleared"}
 
 # 1. CodeSystem
+def _release_body(kind, version):
+    try:
+        return store.body(kind, version)
+    except KeyError:
+        raise HTTPException(404, f"Unknown terminology version {version}")
+
+def _release_diff(kind, from_version, to_version):
+    try:
+        return store.diff(kind, from_version, to_version)
+    except KeyError as e:
+        raise HTTPException(404, f"Unknown terminology version {e.args[0]}")
+
 @app.get("/CodeSystem/namaste")
-def get_codesystem(_history: str = Query(None, alias="_history")):
-    with open('namaste_codesystem.json', 'r', encoding='utf-8') as f:
-        cs = json.load(f)
-    if _history:
-        cs['version'] = _history
-    return cs
+def get_codesystem(request: Request, _history: str = Query(None, alias="_history")):
+    version = _history or store.latest()
+    if not version:
+        raise HTTPException(404, "No terminology release loaded")
+    return compressed_bodies.response(request, ("concept", version), _release_body("concept", version))
+
+@app.get("/CodeSystem/namaste/_history")
+def codesystem_history():
+    return {"versions": store.versions()}
+
+@app.get("/CodeSystem/namaste/$diff")
+def codesystem_diff(from_version: str = Query(..., alias="from"), to_version: str = Query(..., alias="to")):
+    return _release_diff("concept", from_version, to_version)
 
 
 # 2. ConceptMap
+# A re-ingest (python ingest.py) records a new release while the API is running;
+# the live ConceptMap and the /Bundle enrichment follow it by rebuilding / dropping
+# only the codes the release diff names
+_release_lock = threading.Lock()
+
+def _follow_release():
+    latest = store.latest()
+    if latest == conceptmap_cache.version:
+        return
+    with _release_lock:
+        current = conceptmap_cache.version
+        if latest == current:
+            return
+        if current and store.has_version(current):
+            mapping = store.diff("mapping", current, latest)
+            mapped = mapping["added"] + mapping["changed"] + mapping["removed"]
+            conceptmap_cache.advance(latest, mapped)
+            # enrichment also carries the concept's definitions
+            concept = store.diff("concept", current, latest)
+            enrichment_cache.invalidate(namc_codes=mapped + concept["changed"] + concept["removed"])
+        else:
+            conceptmap_cache.load()
+            conceptmap_cache.version = latest
+            enrichment_cache.invalidate()
+
 @app.get("/ConceptMap/namaste-tm2")
-def get_conceptmap(_history: str = Query(None, alias="_history")):
-    with open('namaste_tm2_conceptmap.json', 'r', encoding='utf-8') as f:
-        cm = json.load(f)
+def get_conceptmap(request: Request, _history: str = Query(None, alias="_history"), stream: bool = Query(False)):
     if _history:
-        cm['version'] = _history
-    return cm
+        # a pinned release is immutable; /sync title updates are recorded as new releases
+        return compressed_bodies.response(request, ("mapping", _history), _release_body("mapping", _history))
+    _follow_release()
+    if stream:
+        return StreamingResponse(conceptmap_cache.iter_chunks(), media_type="application/json")
+    return compressed_bodies.response(request, ("mapping", None), conceptmap_cache.body())
+
+@app.get("/ConceptMap/namaste-tm2/$diff")
+def conceptmap_diff(from_version: str = Query(..., alias="from"), to_version: str = Query(..., alias="to")):
+    return _release_diff("mapping", from_version, to_version)
 
 # 3. ValueSet expand (autocomplete)
 class ValueSetExpandResponse(BaseModel):
     expansion: list[dict]
 
-@app.get("/ValueSet/namaste/$expand", response_model=ValueSetExpandResponse)
+# expansion entries are encoded once per (code, display, tm2, similarity) row and
+# spliced together; the extension scaffolding is constant
+_TM2_EXT = b',"extension":[{"url":"tm2","valueCode":'
+_SIMILARITY_EXT = b'},{"url":"similarity","valueDecimal":'
+expansion_fragments = FragmentCache()
+
+def _expansion_entry(code, display, tm2_code, similarity):
+    return (b'{"code":' + dumps(code) + b',"display":' + dumps(display)
+            + _TM2_EXT + dumps(tm2_code) + _SIMILARITY_EXT + dumps(similarity) + b'}]}')
+
+# response_model only documents the shape; the body is built from trusted rows
+@app.get("/ValueSet/namaste/$expand", responses={200: {"model": ValueSetExpandResponse}})
 def valueset_expand(filter: str = Query(..., min_length=3)):
     query = """
     SELECT n.NAMC_CODE as code, n.NAMC_term as display, m."TM2 Code" as tm2_code, m.Similarity_Score as similarity
@@ -76,15 +267,8 @@ def valueset_expand(filter: str = Query(..., min_length=3)):
     cursor = conn.cursor()
     cursor.execute(query, (f"%{filter}%", f"%{filter}%"))
     results = cursor.fetchall()
-    expansion = [{
-        "code": row[0],
-        "display": row[1],
-        "extension": [
-            {"url": "tm2", "valueCode": row[2]},
-            {"url": "similarity", "valueDecimal": row[3]}
-        ]
-    } for row in results]
-    return {"expansion": expansion}
+    entries = [expansion_fragments.get(row, _expansion_entry) for row in results]
+    return raw_json(b'{"expansion":[' + b",".join(entries) + b"]}")
 
 # 4. ConceptMap translate
 class TranslateRequest(BaseModel):
@@ -108,30 +292,32 @@ def conceptmap_translate(request: TranslateRequest):
     cursor.execute(query, (request.code,))
     result = cursor.fetchone()
     if result:
-        return {
+        return FastJSONResponse({
             "result": True,
             "match": [{
                 "equivalence": "equivalent",
                 "concept": {"code": result[0]}
             }]
-        }
+        })
     raise HTTPException(404, "No mapping found")
 
 # 5. Biomed lookup
-@app.get("/CodeSystem/biomed/$lookup")
+@app.get("/CodeSystem/biomed/$lookup", dependencies=[Depends(admit_caller)])
 def biomed_lookup(code: str = Query(...)):
     cursor = conn.cursor()
     cursor.execute("SELECT title, definition FROM biomed_codes WHERE code = ?", (code,))
     result = cursor.fetchone()
     if result:
         return {"code": code, "display": result[0], "definition": result[1]}
-    who_token = get_who_token()
-    headers = {
-        "Authorization": f"Bearer {who_token}",
-        "Accept": "application/json",
-        "Accept-Language": "en"
-    }
-    resp = requests.get(f"https://id.who.int/icd/release/11/2024-01/mms/{code}", headers=headers)
+    with admission.upstream("who"):
+        who_token = get_who_token()
+        headers = {
+            "Authorization": f"Bearer {who_token}",
+            "Accept": "application/json",
+            "Accept-Language": "en"
+        }
+        with span("who", f"GET mms/{code}"):
+            resp = requests.get(f"https://id.who.int/icd/release/11/2024-01/mms/{code}", headers=headers)
     if resp.status_code == 200:
         data = resp.json()
         conn.execute("INSERT OR REPLACE INTO biomed_codes (code, title, definition) VALUES (?, ?, ?)",
@@ -143,130 +329,96 @@ def biomed_lookup(code: str = Query(...)):
 def get_who_token():
     client_id = "your_who_client_id"  # Replace with real credentials
     client_secret = "your_who_client_secret"
-    resp = requests.post("https://icdaccessmanagement.who.int/connect/token", data={
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "scope": "icdapi_access",
-        "grant_type": "client_credentials"
-    })
+    with span("who", "POST connect/token"):
+        resp = requests.post("https://icdaccessmanagement.who.int/connect/token", data={
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "scope": "icdapi_access",
+            "grant_type": "client_credentials"
+        })
     return resp.json().get("access_token")
 
 # 6. Sync TM2 or other WHO chapters
-@app.post("/sync")
+@app.post("/sync", dependencies=[Depends(admit_caller)])
 def sync_who_data(chapter: str = Query("26", description="e.g., 26 for TM2")):
-    who_token = get_who_token()
-    headers = {"Authorization": f"Bearer {who_token}", "Accept": "application/json"}
-    resp = requests.get(f"https://id.who.int/icd/release/11/2024-01/mms/search?q=chapter:{chapter}", headers=headers)
+    with admission.upstream("who"):
+        who_token = get_who_token()
+        headers = {"Authorization": f"Bearer {who_token}", "Accept": "application/json"}
+        with span("who", f"GET mms/search chapter:{chapter}"):
+            resp = requests.get(f"https://id.who.int/icd/release/11/2024-01/mms/search?q=chapter:{chapter}", headers=headers)
     if resp.status_code == 200:
         data = resp.json().get('results', [])
+        synced_tm2 = []
+        # start from the latest release so the snapshot below only adds the new titles
+        _follow_release()
         for item in data:
             code = item.get('code')
             title = item.get('title')
             if chapter == "26":
-                conn.execute("INSERT OR REPLACE INTO tm2_entities (\"TM2 Code\", Title) VALUES (?, ?)", (code, title))
+                # tm2_entities has no unique key on "TM2 Code": update in place, insert
+                # only codes we don't have (INSERT OR REPLACE would append duplicates)
+                updated = conn.execute('UPDATE tm2_entities SET Title = ? WHERE "TM2 Code" = ?', (title, code))
+                if updated.rowcount == 0:
+                    conn.execute('INSERT INTO tm2_entities ("TM2 Code", Title) VALUES (?, ?)', (code, title))
+                synced_tm2.append(code)
             else:
                 conn.execute("INSERT OR REPLACE INTO biomed_codes (code, title) VALUES (?, ?)", (code, title))
         conn.commit()
-        return {"status": "Synced", "count": len(data)}
+        # TM2 titles feed target displays; rebuild only those ConceptMap elements and
+        # record the result as a release, so the live map's version matches _history
+        release = None
+        if synced_tm2:
+            with _release_lock:
+                conceptmap_cache.refresh(tm2_codes=synced_tm2)
+                release = store.snapshot_tables(conceptmap_cache)
+                if release:
+                    conceptmap_cache.advance(release["version"])
+        # biomed_codes rows may have changed too; drop enrichment built on them
+        enrichment_cache.invalidate(tm2_codes=[item.get('code') for item in data])
+        return {"status": "Synced", "count": len(data), "release": release and release["version"]}
     raise HTTPException(500, "Sync failed")
 
 # 7. Upload FHIR Bundle
-@app.post("/Bundle")
-def upload_bundle(bundle: dict):
+@app.post("/Bundle", dependencies=[Depends(admit_caller)])
+def upload_bundle(bundle: dict, idempotency_key: str = Header(None, alias="Idempotency-Key")):
     # Validate bundle structure
     if bundle.get("resourceType") != "Bundle":
         raise HTTPException(400, "Invalid FHIR Bundle: resourceType must be 'Bundle'")
-    
+
+    # Retries (same Idempotency-Key, or same content when no key is sent) get the
+    # stored result instead of another enrichment + Supabase insert. Keys are scoped
+    # to the caller admit_caller identified, so two EMRs never share a result.
+    bundle_hash = content_hash(bundle)
+    caller = current_client.get()
+    key = f"{caller}:key:{idempotency_key}" if idempotency_key else f"{caller}:{bundle_hash}"
+    with idempotency.lock(key):
+        stored = idempotency.get(key)
+        if stored:
+            if stored[0] != bundle_hash:
+                raise HTTPException(422, "Idempotency-Key was already used for a different bundle")
+            return raw_json(stored[1], headers={"Idempotent-Replayed": "true"})
+        body = dumps(_process_bundle(bundle))
+        # recorded whenever Supabase accepted the insert, degraded or not: a retry
+        # must never insert again (degraded bundles carry the enrichment-incomplete tag)
+        idempotency.put(key, bundle_hash, body)
+    return raw_json(body)
+
+def _process_bundle(bundle: dict):
     problems = [entry['resource'] for entry in bundle.get('entry', []) if entry['resource'].get('resourceType') == 'Condition']
     if not problems:
         raise HTTPException(400, "Bundle must contain at least one Condition resource")
 
+    _follow_release()
+    complete = True
     for problem in problems:
         codes = problem.get('code', {}).get('coding', [])
-        namaste_codes = [c for c in codes if c.get('system') == "http://example.org/fhir/CodeSystem/namaste"]
-        
-        # Validate NAMASTE codes
-        for nc in namaste_codes:
-            code = nc['code']
-            cursor = conn.cursor()
-            cursor.execute("SELECT \"TM2 Code\" FROM mapped_terms WHERE NAMC_CODE = ?", (code,))
-            result = cursor.fetchone()
-            if not result:
-                raise HTTPException(400, f"No TM2 mapping for NAMASTE code {code}")
-            tm2_code = result[0]
-            
-            # Verify TM2 code in coding list; add if missing
-            existing_tm2 = any(c.get('system') == "http://who.int/icd11/tm2" and c.get('code') == tm2_code for c in codes)
-            if not existing_tm2:
-                try:
-                    lookup_response = biomed_lookup(code=tm2_code)
-                    codes.append({
-                        "system": "http://who.int/icd11/tm2",
-                        "code": tm2_code,
-                        "display": lookup_response.get('display', '')
-                    })
-                except HTTPException:
-                    codes.append({
-                        "system": "http://who.int/icd11/tm2",
-                        "code": tm2_code,
-                        "display": ""
-                    })
-                    logger.warning(f"Could not fetch TM2 display for {tm2_code}")
-
-        # Validate extensions
-        extensions = problem.get('extension', [])
-        expected_extensions = [
-            "http://example.org/fhir/extension/index-term",
-            "http://example.org/fhir/extension/short-definition",
-            "http://example.org/fhir/extension/long-definition",
-            "http://example.org/fhir/extension/tm2-definition"
-        ]
-        existing_urls = [ext.get('url') for ext in extensions]
-        
-        # Enrich missing extensions if necessary
-        for nc in namaste_codes:
-            code = nc['code']
-            if "http://example.org/fhir/extension/short-definition" not in existing_urls or \
-               "http://example.org/fhir/extension/long-definition" not in existing_urls or \
-               "http://example.org/fhir/extension/index-term" not in existing_urls:
-                try:
-                    with open('namaste_codesystem.json', 'r', encoding='utf-8') as f:
-                        cs = json.load(f)
-                    concepts = cs.get("concept", [])
-                    concept = next((c for c in concepts if c.get("code") == code), None)
-                    if concept:
-                        if "http://example.org/fhir/extension/short-definition" not in existing_urls:
-                            extensions.append({
-                                "url": "http://example.org/fhir/extension/short-definition",
-                                "valueString": concept.get("display", nc.get("display", ""))
-                            })
-                        if "http://example.org/fhir/extension/long-definition" not in existing_urls:
-                            extensions.append({
-                                "url": "http://example.org/fhir/extension/long-definition",
-                                "valueString": concept.get("definition", "")
-                            })
-                        if "http://example.org/fhir/extension/index-term" not in existing_urls:
-                            extensions.append({
-                                "url": "http://example.org/fhir/extension/index-term",
-                                "valueString": concept.get("display", nc.get("display", ""))
-                            })
-                except Exception as e:
-                    logger.warning(f"Could not fetch NAMASTE details for {code}: {str(e)}")
-
-        # Enrich TM2 definition if missing
-        for c in codes:
-            if c.get('system') == "http://who.int/icd11/tm2" and \
-               "http://example.org/fhir/extension/tm2-definition" not in existing_urls:
-                try:
-                    lookup_response = biomed_lookup(code=c['code'])
-                    extensions.append({
-                        "url": "http://example.org/fhir/extension/tm2-definition",
-                        "valueString": lookup_response.get('definition', '')
-                    })
-                except HTTPException:
-                    pass  # Skip if lookup fails
-
-        problem['extension'] = extensions
+        namaste_codes = [c['code'] for c in codes if c.get('system') == NAMASTE_SYSTEM]
+        # TM2 coding + definition extensions come precomputed per NAMASTE code
+        try:
+            with span("enrichment", ",".join(namaste_codes)):
+                complete = enrich_condition(problem, namaste_codes, enrichment_cache, logger) and complete
+        except LookupError as e:
+            raise HTTPException(400, f"No TM2 mapping for NAMASTE code {e.args[0]}")
 
     # Add meta to bundle
     bundle['meta'] = {
@@ -274,6 +426,10 @@ def upload_bundle(bundle: dict):
         "lastUpdated": datetime.now().isoformat(),
         "tag": [{"code": "consent-granted"}]
     }
+    if not complete:
+        # some TM2 details could not be fetched from WHO; the stored row is tagged so
+        # it can be re-enriched later without inserting the bundle again
+        bundle['meta']['tag'].append({"code": "enrichment-incomplete"})
 
     # Send to Supabase
     try:
@@ -288,14 +444,63 @@ def upload_bundle(bundle: dict):
         supabase_data = {
             "bundle_data": bundle  # Assumes a jsonb column 'bundle_data' in table 'fhir_bundles'
         }
-        response = requests.post(f"{supabase_url}/rest/v1/fhir_bundles", headers=headers, json=supabase_data)
+        with admission.upstream("supabase"):
+            with span("supabase", "POST fhir_bundles"):
+                response = requests.post(f"{supabase_url}/rest/v1/fhir_bundles", headers=headers, json=supabase_data)
         response.raise_for_status()
         logger.info(f"Bundle successfully uploaded to Supabase")
+    except AdmissionDenied:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Failed to upload to Supabase: {str(e)}")
 
     return bundle
 
+# 8. Bulk export of NAMASTE concepts, TM2 entities and mappings
+@app.get("/$export")
+def bulk_export(
+    request: Request,
+    _type: str = Query("namaste,tm2,mapping", alias="_type"),
+    _outputFormat: str = Query("application/fhir+ndjson", alias="_outputFormat"),
+    _history: str = Query(None, alias="_history"),
+):
+    types = [t.strip() for t in _type.split(",") if t.strip()]
+    unknown = [t for t in types if t not in EXPORT_TABLES]
+    if not types or unknown:
+        raise HTTPException(400, f"Unsupported _type {unknown or _type}; use {', '.join(EXPORT_TABLES)}")
+    fmt = FORMAT_ALIASES.get(_outputFormat.lower())
+    if fmt is None:
+        raise HTTPException(400, f"Unsupported _outputFormat {_outputFormat}")
+    if fmt != "ndjson":
+        if len(types) != 1:
+            raise HTTPException(400, f"{fmt} export takes exactly one _type")
+        if _history:
+            raise HTTPException(400, "_history is only supported for NDJSON export")
+    if fmt == "parquet" and not parquet_available():
+        raise HTTPException(501, "Parquet export requires pyarrow")
+    version = _history or store.latest()
+    if version and not store.has_version(version):
+        raise HTTPException(404, f"Unknown terminology version {version}")
+
+    # Parquet pages are already compressed
+    encoding = None if fmt == "parquet" else pick_encoding(request.headers.get("accept-encoding"))
+    headers = {"Content-Disposition": f'attachment; filename="namaste-export.{fmt}"', "Vary": "Accept-Encoding"}
+    # only NDJSON concepts / mappings come from the versioned store; tm2 rows and all
+    # CSV / Parquet output are read from the live tables, which /sync updates
+    versioned = [t for t in types if fmt == "ndjson" and t != "tm2"]
+    if version and versioned:
+        headers["X-Terminology-Version"] = version
+    unversioned = [t for t in types if t not in versioned]
+    if unversioned:
+        headers["X-Terminology-Unversioned"] = ",".join(unversioned)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return StreamingResponse(
+        export_stream(DB_PATH, types, fmt, version, encoding),
+        media_type=FORMATS[fmt],
+        headers=headers,
+    )
+
 # Entry point
 if __name__ == "__main__":
     import uvicorn
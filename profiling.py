@@ -0,0 +1,239 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime
+
+# Opt-in slow-request tracing (PROFILE_ENABLED=1). While a traced request runs, span()
+# records timed steps (SQLite queries, WHO / Supabase / OAuth calls, enrichment) and a
+# sampler thread snapshots the stacks of the threads it ran on. Requests slower than
+# PROFILE_SLOW_MS are kept in a bounded ring buffer for the admin endpoint.
+#
+# Disabled, no middleware or traced connection is installed and span() is one
+# ContextVar lookup returning a shared no-op.
+
+_current: ContextVar = ContextVar("profiling_trace", default=None)
+
+MAX_SPANS = 500       # per trace; later spans are only counted
+MAX_STACKS = 200      # distinct sampled stacks per trace
+MAX_DEPTH = 64        # frames kept per sampled stack
+MAX_DETAIL = 200
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Trace:
+    __slots__ = ("method", "path", "started_at", "started", "duration_ms", "status",
+                 "spans", "dropped_spans", "threads", "samples")
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.started_at = datetime.utcnow().isoformat()
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.status = None
+        self.spans = []       # (name, start offset s, duration s, detail, error)
+        self.dropped_spans = 0
+        self.threads = {threading.get_ident()}
+        self.samples = Counter()
+
+    def to_dict(self, sample_interval_ms):
+        totals = {}
+        for name, _, duration, _, _ in self.spans:
+            entry = totals.setdefault(name, {"count": 0, "total_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] += duration * 1000
+        for entry in totals.values():
+            entry["total_ms"] = round(entry["total_ms"], 2)
+        return {
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "span_totals": totals,
+            "spans": [
+                {"name": name, "start_ms": round(start * 1000, 2), "duration_ms": round(duration * 1000, 2),
+                 "detail": detail, **({"error": error} if error else {})}
+                for name, start, duration, detail, error in self.spans
+            ],
+            "dropped_spans": self.dropped_spans,
+            "sample_interval_ms": sample_interval_ms,
+            "samples": [{"stack": stack, "count": count} for stack, count in self.samples.most_common(50)],
+        }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "detail", "start")
+
+    def __init__(self, trace, name, detail):
+        self.trace = trace
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        # sync handlers run in the threadpool; the first span tells the sampler where
+        self.trace.threads.add(threading.get_ident())
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        trace = self.trace
+        if len(trace.spans) < MAX_SPANS:
+            detail = self.detail
+            if detail is not None and len(detail) > MAX_DETAIL:
+                detail = detail[:MAX_DETAIL] + "..."
+            trace.spans.append((self.name, self.start - trace.started, end - self.start, detail,
+                                exc_type.__name__ if exc_type else None))
+        else:
+            trace.dropped_spans += 1
+        return False
+
+
+def span(name, detail=None):
+    """Time a step of the current request; a no-op unless the request is traced."""
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, detail)
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        with span("sqlite", " ".join(sql.split())):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with span("sqlite", " ".join(sql.split())):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class TracedConnection(sqlite3.Connection):
+    """sqlite3 connection whose queries show up as spans (time to first row)."""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _stack(frame):
+    parts = []
+    while frame is not None and len(parts) < MAX_DEPTH:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+class Profiler:
+    def __init__(self, enabled=False, slow_ms=1000.0, sample_interval_ms=10.0, max_traces=50):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.sample_interval_ms = sample_interval_ms
+        self.traces = deque(maxlen=max_traces)
+        self._active = set()
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.getenv("PROFILE_ENABLED", "0") == "1",
+            slow_ms=float(os.getenv("PROFILE_SLOW_MS", "1000")),
+            sample_interval_ms=float(os.getenv("PROFILE_SAMPLE_MS", "10")),
+            max_traces=int(os.getenv("PROFILE_MAX_TRACES", "50")),
+        )
+
+    def connection_factory(self):
+        return TracedConnection if self.enabled else sqlite3.Connection
+
+    def start(self, method, path):
+        trace = Trace(method, path)
+        with self._lock:
+            self._active.add(trace)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+                self._sampler.start()
+        return trace, _current.set(trace)
+
+    def finish(self, trace, token):
+        _current.reset(token)
+        trace.duration_ms = round((time.perf_counter() - trace.started) * 1000, 2)
+        with self._lock:
+            self._active.discard(trace)
+        if trace.duration_ms >= self.slow_ms:
+            self.traces.append(trace)
+
+    def recent(self, limit=None):
+        """Slow traces, newest first."""
+        traces = list(self.traces)[::-1][:limit]
+        return [t.to_dict(self.sample_interval_ms) for t in traces]
+
+    def clear(self):
+        self.traces.clear()
+
+    def _sample_loop(self):
+        # Samples every in-flight traced request. Async handlers share the event-loop
+        # thread, so their samples can include other requests running concurrently.
+        interval = self.sample_interval_ms / 1000
+        me = threading.get_ident()
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                active = list(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for trace in active:
+                for tid in list(trace.threads):
+                    frame = frames.get(tid)
+                    if frame is None or tid == me:
+                        continue
+                    stack = _stack(frame)
+                    if stack in trace.samples or len(trace.samples) < MAX_STACKS:
+                        trace.samples[stack] += 1
+            del frames
+
+
+class ProfilingMiddleware:
+    """ASGI middleware tracing each HTTP request; only installed when profiling is on."""
+
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trace, token = self.profiler.start(scope["method"], scope["path"])
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.profiler.finish(trace, token)
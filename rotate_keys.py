@@ -0,0 +1,154 @@
+"""Re-encrypt abha_links tokens under the primary ENCRYPTION_KEYS key.
+
+Rows are streamed in keyset-paginated batches (ordered by emr_patient_id), tokens are
+rotated in a thread pool and written back with per-row compare-and-swap updates
+(only if the tokens are still the ones read), issued from the same pool. Progress is
+checkpointed to a file so an interrupted run resumes where it stopped, and the job
+throttles itself to --max-rows-per-sec so live traffic keeps its Supabase budget.
+
+    ENCRYPTION_KEYS=<new>,<old> python rotate_keys.py --batch-size 500 --max-rows-per-sec 200
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import InvalidToken
+
+from db import get_supabase
+from secure import keys, is_current, rotate_value
+
+logger = logging.getLogger("rotate_keys")
+
+TOKEN_COLUMNS = ("access_token", "refresh_token")
+UNREADABLE = object()  # _rotate_row result for a token no configured key can decrypt
+
+
+def _key_fingerprint() -> str:
+    # ties a checkpoint to the primary key it was rotating to
+    return hashlib.sha256(keys()[0].encode()).hexdigest()[:16]
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.state = {"key": _key_fingerprint(), "last_id": None, "scanned": 0, "rotated": 0, "skipped": 0,
+                      "unreadable": 0, "done": False}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("key") == self.state["key"]:
+                self.state = {**self.state, **saved}
+            else:
+                logger.info("Checkpoint belongs to another primary key; starting over")
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+
+def _rotate_row(row):
+    """Updated token columns for a row, None if nothing needs rotating, or UNREADABLE."""
+    updates = {}
+    for column in TOKEN_COLUMNS:
+        token = row.get(column)
+        if token and not is_current(token):
+            try:
+                updates[column] = rotate_value(token)
+            except InvalidToken:
+                # one bad row must not abort (and on rerun re-abort) the whole job
+                logger.warning(f"{column} of {row['emr_patient_id']} cannot be decrypted with any configured key; skipping")
+                return UNREADABLE
+    return updates or None
+
+
+class RotationJob:
+    def __init__(self, client=None, batch_size=500, workers=4, max_rows_per_sec=200.0,
+                 checkpoint_path="rotate_keys.checkpoint.json"):
+        self.client = client or get_supabase()
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_rows_per_sec = max_rows_per_sec
+        self.checkpoint = Checkpoint(checkpoint_path)
+
+    def _fetch_batch(self, last_id):
+        query = self.client.table("abha_links").select("emr_patient_id, " + ", ".join(TOKEN_COLUMNS))
+        if last_id is not None:
+            query = query.gt("emr_patient_id", last_id)
+        return query.order("emr_patient_id").limit(self.batch_size).execute().data
+
+    def _write_if_unchanged(self, row, updates):
+        """Compare-and-swap one row: only written if its tokens are still the ones we read.
+
+        A concurrent /abha/refresh (or a deleted row) makes the update match nothing, so
+        live tokens are never overwritten by older rotated ones and nothing is re-created.
+        """
+        query = self.client.table("abha_links").update(updates).eq("emr_patient_id", row["emr_patient_id"])
+        for column in TOKEN_COLUMNS:
+            value = row.get(column)
+            query = query.eq(column, value) if value is not None else query.is_(column, "null")
+        return bool(query.execute().data)
+
+    def run(self):
+        state = self.checkpoint.state
+        if state["done"]:
+            logger.info("Rotation already complete for this key")
+            return state
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                started = time.monotonic()
+                rows = self._fetch_batch(state["last_id"])
+                if not rows:
+                    break
+                results = list(pool.map(_rotate_row, rows))
+                state["unreadable"] += sum(1 for u in results if u is UNREADABLE)
+                pending = [(row, u) for row, u in zip(rows, results) if u and u is not UNREADABLE]
+                if pending:
+                    written = sum(pool.map(lambda item: self._write_if_unchanged(*item), pending))
+                    state["rotated"] += written
+                    state["skipped"] += len(pending) - written
+                state["scanned"] += len(rows)
+                state["last_id"] = rows[-1]["emr_patient_id"]
+                self.checkpoint.save()
+                logger.info(f"scanned={state['scanned']} rotated={state['rotated']} last_id={state['last_id']}")
+
+                if len(rows) < self.batch_size:
+                    break
+                # throttle: spread batches so we stay under max_rows_per_sec
+                if self.max_rows_per_sec:
+                    wait = len(rows) / self.max_rows_per_sec - (time.monotonic() - started)
+                    if wait > 0:
+                        time.sleep(wait)
+        state["done"] = True
+        self.checkpoint.save()
+        return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-encrypt abha_links tokens under the primary key")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-rows-per-sec", type=float, default=200.0, help="0 disables throttling")
+    parser.add_argument("--checkpoint", default="rotate_keys.checkpoint.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if len(keys()) < 2:
+        logger.warning("Only one key configured; tokens under other keys cannot be decrypted")
+    state = RotationJob(
+        batch_size=args.batch_size,
+        workers=args.workers,
+        max_rows_per_sec=args.max_rows_per_sec,
+        checkpoint_path=args.checkpoint,
+    ).run()
+    print(f"Scanned {state['scanned']} links, rotated {state['rotated']}, "
+          f"skipped {state['skipped']} changed during rotation and {state['unreadable']} unreadable")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,46 @@
 import os
-from cryptography.fernet import Fernet
+import threading
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 
 #Put this in env or secret manager (DO NOT COMMIT TO REPO)
 
-KEY = os.getenv("ENCRYPTION_KEY")
-if not KEY:
-    raise RuntimeError("ENCRYPTION_KEY environment variable not set (Fernet key required)")
+# ENCRYPTION_KEYS: comma-separated Fernet keys, newest first. New tokens are encrypted
+# with the first key; older keys stay valid for decryption until rotate_keys.py has
+# re-encrypted every stored token. ENCRYPTION_KEY alone still works (single key).
+# Keys are read on first use, so importing this module never fails.
+_fernets = None
+_lock = threading.Lock()
 
-fernet = Fernet(KEY.encode() if isinstance(KEY, str) else KEY)
+def keys() -> list:
+    raw = os.getenv("ENCRYPTION_KEYS") or os.getenv("ENCRYPTION_KEY") or ""
+    found = [k.strip() for k in raw.split(",") if k.strip()]
+    if not found:
+        raise RuntimeError("ENCRYPTION_KEY environment variable not set (Fernet key required)")
+    return found
+
+def _get():
+    global _fernets
+    if _fernets is None:
+        with _lock:
+            if _fernets is None:
+                found = keys()
+                _fernets = (Fernet(found[0].encode()), MultiFernet([Fernet(k.encode()) for k in found]))
+    return _fernets
 
 def encrypt_value(plain: str) -> str:
-    return fernet.encrypt(plain.encode()).decode()
+    return _get()[1].encrypt(plain.encode()).decode()
 
 def decrypt_value(token: str) -> str:
-    return fernet.decrypt(token.encode()).decode()
+    return _get()[1].decrypt(token.encode()).decode()
+
+def is_current(token: str) -> bool:
+    """True if token is already encrypted with the primary key."""
+    try:
+        _get()[0].decrypt(token.encode())
+        return True
+    except InvalidToken:
+        return False
+
+def rotate_value(token: str) -> str:
+    """Re-encrypt token under the primary key (keeps its original timestamp)."""
+    return _get()[1].rotate(token.encode()).decode()
@@ -2,8 +2,7 @@ import streamlit as st
 import requests
 import json
 from uuid import uuid4
-
-API_BASE_URL = "http://localhost:8000/"  # Adjust if deployed elsewhere
+import api_client  # pooled session + cached reads; API_BASE_URL env var, default http://localhost:8000
 
 st.title("NAMASTE Terminology API Explorer")
 
@@ -27,13 +26,8 @@ with tabs[1]:
     st.header("CodeSystem Namaste")
     version = st.text_input("Version (_history) (optional)")
     if st.button("Get CodeSystem"):
-        params = {}
-        if version:
-            params["_history"] = version
         try:
-            r = requests.get(f"{API_BASE_URL}/CodeSystem/namaste", params=params)
-            r.raise_for_status()
-            cs = r.json()
+            cs = api_client.codesystem(version or None)
             st.json(cs)
         except Exception as e:
             st.error(f"Error fetching CodeSystem: {e}")
@@ -42,13 +36,8 @@ with tabs[2]:
     st.header("ConceptMap Namaste-TM2")
     version = st.text_input("Version (_history) (optional)", key="cm_version")
     if st.button("Get ConceptMap"):
-        params = {}
-        if version:
-            params["_history"] = version
         try:
-            r = requests.get(f"{API_BASE_URL}/ConceptMap/namaste-tm2", params=params)
-            r.raise_for_status()
-            cm = r.json()
+            cm = api_client.conceptmap(version or None)
             st.json(cm)
         except Exception as e:
             st.error(f"Error fetching ConceptMap: {e}")
@@ -58,9 +47,7 @@ with tabs[3]:
     filter_text = st.text_input("Filter (min 3 characters)")
     if st.button("Expand") and len(filter_text) >= 3:
         try:
-            r = requests.get(f"{API_BASE_URL}/ValueSet/namaste/$expand", params={"filter": filter_text})
-            r.raise_for_status()
-            expansion = r.json().get("expansion", [])
+            expansion = api_client.expand(filter_text)
             if not expansion:
                 st.info("No results found")
             else:
@@ -87,9 +74,7 @@ with tabs[4]:
         else:
             try:
                 payload = {"code": code, "system": system, "targetsystem": targetsystem}
-                r = requests.post(f"{API_BASE_URL}/ConceptMap/$translate", json=payload)
-                r.raise_for_status()
-                result = r.json()
+                result = api_client.post("/ConceptMap/$translate", json=payload).json()
                 st.success(f"Match found: {result}")
             except requests.HTTPError as he:
                 if he.response.status_code == 404:
@@ -107,17 +92,15 @@ with tabs[5]:
             st.error("Please enter a code")
         else:
             try:
-                r = requests.get(f"{API_BASE_URL}/CodeSystem/biomed/$lookup", params={"code": code})
-                r.raise_for_status()
-                data = r.json()
-                st.write(f"**Code:** {data.get('code')}")
-                st.write(f"**Display:** {data.get('display')}")
-                st.write(f"**Definition:** {data.get('definition')}")
-            except requests.HTTPError as he:
-                if he.response.status_code == 404:
+                data = api_client.lookup(code)
+                if data is None:
                     st.warning("Code not found")
                 else:
-                    st.error(f"HTTP error: {he}")
+                    st.write(f"**Code:** {data.get('code')}")
+                    st.write(f"**Display:** {data.get('display')}")
+                    st.write(f"**Definition:** {data.get('definition')}")
+            except requests.HTTPError as he:
+                st.error(f"HTTP error: {he}")
             except Exception as e:
                 st.error(f"Error looking up code: {e}")
 
@@ -126,9 +109,7 @@ with tabs[6]:
     chapter = st.text_input("Chapter code (e.g., 26 for TM2)", value="26")
     if st.button("Sync Data"):
         try:
-            r = requests.post(f"{API_BASE_URL}/sync", params={"chapter": chapter})
-            r.raise_for_status()
-            result = r.json()
+            result = api_client.post("/sync", params={"chapter": chapter}).json()
             st.success(f"Sync status: {result.get('status')}, Count: {result.get('count')}")
         except Exception as e:
             st.error(f"Error syncing data: {e}")
@@ -146,9 +127,7 @@ with tabs[7]:
     filter_text = st.text_input("Enter disorder name (min 3 characters)", key="disorder_search")
     if filter_text and len(filter_text) >= 3:
         try:
-            r = requests.get(f"{API_BASE_URL}/ValueSet/namaste/$expand", params={"filter": filter_text})
-            r.raise_for_status()
-            expansion = r.json().get("expansion", [])
+            expansion = api_client.expand(filter_text)
             if not expansion:
                 st.info("No disorders found")
             else:
@@ -156,70 +135,25 @@ with tabs[7]:
                 disorder_options = [f"{item['display']} (Code: {item['code']})" for item in expansion]
                 selected_options = st.multiselect("Select disorders", options=disorder_options)
                 if st.button("Add Selected Disorders"):
+                    already = {d['code'] for d in st.session_state.selected_disorders}
+                    to_add = []
                     for selected_option in selected_options:
                         # Extract code and display from selected option
                         selected_code = selected_option.split(" (Code: ")[1].rstrip(")")
                         selected_display = selected_option.split(" (Code: ")[0]
                         # Check if already added to avoid duplicates
-                        if selected_code not in [d['code'] for d in st.session_state.selected_disorders]:
-                            # Translate to TM2 code
-                            tm2_code = ""
-                            tm2_display = ""
-                            tm2_definition = ""
-                            try:
-                                r_translate = requests.post(f"{API_BASE_URL}/ConceptMap/$translate", json={
-                                    "code": selected_code,
-                                    "system": "namaste",
-                                    "targetsystem": "tm2"
-                                })
-                                r_translate.raise_for_status()
-                                result = r_translate.json()
-                                tm2_code = result.get("match", [{}])[0].get("concept", {}).get("code", "")
-                            except Exception:
-                                st.warning(f"No TM2 mapping found for {selected_code}")
-                            
-                            # Fetch NAMASTE details from CodeSystem
-                            namaste_short = selected_display
-                            namaste_long = ""
-                            index_term = selected_display  # Assume IndexTerm is the display; adjust if diacritical is needed
-                            try:
-                                r_cs = requests.get(f"{API_BASE_URL}/CodeSystem/namaste")
-                                r_cs.raise_for_status()
-                                cs = r_cs.json()
-                                concepts = cs.get("concept", [])
-                                concept = next((c for c in concepts if c.get("code") == selected_code), None)
-                                if concept:
-                                    namaste_short = concept.get("display", selected_display)
-                                    namaste_long = concept.get("definition", "")
-                                    # If IndexTerm is a property, add here: index_term = concept.get("property_index_term", selected_display)
-                            except Exception as e:
-                                st.warning(f"Could not fetch NAMASTE details: {e}")
-                            
-                            # Fetch TM2 details if tm2_code exists
-                            if tm2_code:
-                                try:
-                                    r_lookup = requests.get(f"{API_BASE_URL}/CodeSystem/biomed/$lookup", params={"code": tm2_code})
-                                    r_lookup.raise_for_status()
-                                    data = r_lookup.json()
-                                    tm2_display = data.get("display", "")
-                                    tm2_definition = data.get("definition", "")
-                                except Exception:
-                                    st.warning(f"Could not fetch TM2 details for {tm2_code}")
-                            
-                            # Add to session state
-                            st.session_state.selected_disorders.append({
-                                "code": selected_code,
-                                "display": selected_display,
-                                "tm2_code": tm2_code,
-                                "tm2_display": tm2_display,
-                                "tm2_definition": tm2_definition,
-                                "namaste_short": namaste_short,
-                                "namaste_long": namaste_long,
-                                "index_term": index_term
-                            })
-                            st.success(f"Added {selected_display}")
-                        else:
+                        if selected_code in already:
                             st.info(f"{selected_display} already added")
+                        else:
+                            already.add(selected_code)
+                            to_add.append((selected_code, selected_display))
+                    # NAMASTE details, TM2 codes and TM2 details for all selections at once
+                    records, warnings = api_client.resolve_disorders(to_add)
+                    for warning in warnings:
+                        st.warning(warning)
+                    for record in records:
+                        st.session_state.selected_disorders.append(record)
+                        st.success(f"Added {record['display']}")
         except Exception as e:
             st.error(f"Error fetching disorders: {e}")
 
@@ -289,8 +223,7 @@ with tabs[7]:
 
         # Send to /Bundle endpoint, which handles Supabase upload
         try:
-            r = requests.post(f"{API_BASE_URL}/Bundle", json=bundle)
-            r.raise_for_status()
+            r = api_client.post("/Bundle", json=bundle)
             st.success("Disorders submitted as FHIR Bundle and sent to Supabase successfully")
             st.json(r.json())
             # Clear selections after success
@@ -0,0 +1,236 @@
+import hashlib
+import threading
+from datetime import datetime
+
+from codesystem import CONCEPT_QUERY, build_concept, codesystem_envelope
+from conceptmap import conceptmap_envelope
+from fastjson import dumps
+from lru import LRU
+
+# "concept" items make up the CodeSystem, "mapping" items the ConceptMap
+KINDS = ("concept", "mapping")
+
+
+def _envelope(kind, version, count, date):
+    if kind == "concept":
+        return codesystem_envelope(version, count, date)
+    return conceptmap_envelope(version, date)
+
+
+def _hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _root(manifest: dict) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for code in sorted(manifest):
+        h.update(code.encode("utf-8"))
+        h.update(b"\0")
+        h.update(manifest[code].encode("ascii"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def diff_manifests(old: dict, new: dict) -> dict:
+    """Codes added/removed/changed between two code -> hash manifests."""
+    return {
+        "added": sorted(c for c in new if c not in old),
+        "removed": sorted(c for c in old if c not in new),
+        "changed": sorted(c for c, h in new.items() if c in old and old[c] != h),
+    }
+
+
+class TerminologyStore:
+    """Versioned, content-addressed store of NAMASTE concepts and NAMASTE->TM2 mappings.
+
+    Every concept / ConceptMap element is stored once in tx_blobs under the hash of its
+    encoded JSON. A release is just a manifest of code -> hash per kind plus a root hash,
+    so unchanged concepts are shared between releases and two versions are compared by
+    their hashes only.
+    """
+
+    def __init__(self, conn, max_versions=8, max_blobs=20000):
+        self.conn = conn
+        self._manifests = LRU(max_versions * len(KINDS))
+        self._bodies = LRU(max_versions * len(KINDS))
+        self._blobs = LRU(max_blobs)  # shared by every version
+        self._lock = threading.Lock()
+
+    def ensure_schema(self):
+        self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS tx_releases (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            version TEXT UNIQUE NOT NULL,
+            created_at TEXT NOT NULL,
+            concept_root TEXT NOT NULL,
+            mapping_root TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tx_blobs (hash TEXT PRIMARY KEY, body BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS tx_release_items (
+            version TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            code TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            PRIMARY KEY (version, kind, code)
+        ) WITHOUT ROWID;
+        """)
+        self.conn.commit()
+
+    # ---------- releases ----------
+    def versions(self):
+        rows = self.conn.execute("SELECT version, created_at FROM tx_releases ORDER BY seq").fetchall()
+        return [{"version": v, "created_at": created} for v, created in rows]
+
+    def latest(self):
+        row = self.conn.execute("SELECT version FROM tx_releases ORDER BY seq DESC LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def has_version(self, version):
+        return self.conn.execute(
+            "SELECT 1 FROM tx_releases WHERE version = ?", (version,)
+        ).fetchone() is not None
+
+    def _roots(self, version):
+        row = self.conn.execute(
+            "SELECT concept_root, mapping_root FROM tx_releases WHERE version = ?", (version,)
+        ).fetchone()
+        return {"concept": row[0], "mapping": row[1]} if row else None
+
+    def commit(self, items, version=None, batch_size=1000):
+        """Record a release.
+
+        items maps kind ("concept" / "mapping") to an iterable of (code, encoded_json)
+        pairs; they are consumed once and written in batches. Returns None if the
+        content equals the latest release, otherwise a summary with the new version and
+        per-kind added/removed/changed codes. If version already exists with the same
+        content it becomes the latest release again (summary["repointed"] is True);
+        with different content ValueError is raised after rolling back. Work the caller
+        left open on the connection is committed or rolled back with the release.
+        """
+        with self._lock:
+            previous = self.latest()
+            manifests, pending = {}, []
+            for kind in KINDS:
+                manifest = {}
+                for code, body in items.get(kind, ()):
+                    h = _hash(body)
+                    manifest[code] = h
+                    pending.append((h, body))
+                    if len(pending) >= batch_size:
+                        self._insert_blobs(pending)
+                        pending = []
+                manifests[kind] = manifest
+            self._insert_blobs(pending)
+            roots = {kind: _root(m) for kind, m in manifests.items()}
+
+            if previous is not None and self._roots(previous) == roots:
+                # blobs are content-addressed, so nothing new was written
+                self.conn.commit()
+                return None
+            if version is None:
+                version = _hash((roots["concept"] + roots["mapping"]).encode("ascii"))[:12]
+            existing = self._roots(version)
+            if existing is not None and existing != roots:
+                self.conn.rollback()
+                raise ValueError(f"Terminology version {version} already exists with different content")
+
+            if existing is not None:
+                # same content as an older release (e.g. rolling back to it): make it
+                # the latest again, keeping its items and created_at
+                created_at = self.conn.execute(
+                    "SELECT created_at FROM tx_releases WHERE version = ?", (version,)
+                ).fetchone()[0]
+                self.conn.execute("DELETE FROM tx_releases WHERE version = ?", (version,))
+            else:
+                created_at = datetime.utcnow().isoformat()
+                for kind, manifest in manifests.items():
+                    self.conn.executemany(
+                        "INSERT INTO tx_release_items (version, kind, code, hash) VALUES (?, ?, ?, ?)",
+                        ((version, kind, code, h) for code, h in manifest.items()),
+                    )
+            self.conn.execute(
+                "INSERT INTO tx_releases (version, created_at, concept_root, mapping_root) VALUES (?, ?, ?, ?)",
+                (version, created_at, roots["concept"], roots["mapping"]),
+            )
+            self.conn.commit()
+
+        summary = {"version": version, "previous": previous, "repointed": existing is not None}
+        for kind, manifest in manifests.items():
+            self._manifests.put((version, kind), manifest)
+            old = self.manifest(previous, kind) if previous else {}
+            summary[kind] = diff_manifests(old, manifest)
+        return summary
+
+    def _insert_blobs(self, blobs):
+        if blobs:
+            self.conn.executemany("INSERT OR IGNORE INTO tx_blobs (hash, body) VALUES (?, ?)", blobs)
+
+    def snapshot_tables(self, conceptmap_cache, version=None):
+        """Commit the live namaste_terms / ConceptMap elements as a release."""
+        concepts = (
+            (row[0], dumps(build_concept(*row)))
+            for row in self.conn.execute(CONCEPT_QUERY)
+        )
+        return self.commit({
+            "concept": concepts,
+            "mapping": conceptmap_cache.encoded_elements(),
+        }, version)
+
+    # ---------- reads ----------
+    def manifest(self, version, kind):
+        manifest = self._manifests.get((version, kind))
+        if manifest is None:
+            rows = self.conn.execute(
+                "SELECT code, hash FROM tx_release_items WHERE version = ? AND kind = ?",
+                (version, kind),
+            ).fetchall()
+            manifest = dict(rows)
+            self._manifests.put((version, kind), manifest)
+        return manifest
+
+    def _load_blobs(self, hashes):
+        out, missing = {}, []
+        for h in hashes:
+            body = self._blobs.get(h)
+            if body is None:
+                missing.append(h)
+            else:
+                out[h] = body
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for h, body in self.conn.execute(
+                f"SELECT hash, body FROM tx_blobs WHERE hash IN ({placeholders})", chunk
+            ):
+                body = bytes(body)
+                self._blobs.put(h, body)
+                out[h] = body
+        return out
+
+    def body(self, kind, version) -> bytes:
+        """Encoded CodeSystem ("concept") or ConceptMap ("mapping") for a release."""
+        body = self._bodies.get((kind, version))
+        if body is not None:
+            return body
+        row = self.conn.execute("SELECT created_at FROM tx_releases WHERE version = ?", (version,)).fetchone()
+        if row is None:
+            raise KeyError(version)
+        manifest = self.manifest(version, kind)
+        codes = sorted(manifest)
+        blobs = self._load_blobs(set(manifest.values()))
+        # dated by the release, so a version always serves the same bytes
+        prefix, suffix = _envelope(kind, version, len(codes), row[0][:10])
+        body = prefix + b",".join(blobs[manifest[c]] for c in codes) + suffix
+        self._bodies.put((kind, version), body)
+        return body
+
+    def diff(self, kind, from_version, to_version):
+        for v in (from_version, to_version):
+            if not self.has_version(v):
+                raise KeyError(v)
+        result = {"from": from_version, "to": to_version}
+        if self._roots(from_version)[kind] == self._roots(to_version)[kind]:
+            result.update(added=[], removed=[], changed=[])
+            return result
+        result.update(diff_manifests(self.manifest(from_version, kind), self.manifest(to_version, kind)))
+        return result